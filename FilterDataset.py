@@ -3,60 +3,154 @@ import os
 import sys
 import shutil
 from argparse import ArgumentParser
-from gemmi import cif
+from contextlib import nullcontext
+from functools import lru_cache
+from multiprocessing import Pool
 from HelperModule.Ring import Ring
-from HelperModule.getter_functions import get_data_from_pdb, get_bonds_from_cif
+from HelperModule.component_cache import ComponentCache, open_component_cache
+from HelperModule.getter_functions import get_data_from_pdb
 from HelperModule.helper_functions import are_bonds_correct
+from HelperModule.ring_archive import RingArchiveWriter, read_pattern_atoms
 from HelperModule.constants import *
 
-
-def run_filter(input_dir: str, ring: Ring, output_dir: str, document: cif.Document) -> None:
-    total = 0
+# number of pattern files sent to a worker process at once
+CHUNK_SIZE = 256
+# maximal number of memoized results of the bond check per process
+BOND_CHECK_CACHE_SIZE = 65536
+# how the accepted patterns are placed to the output directory
+OUTPUT_MODES = ("copy", "hardlink", "archive")
+OUTPUT_MODE_ACTIONS = {"copy": "Copying", "hardlink": "Linking", "archive": "Archiving"}
+
+
+@lru_cache(maxsize=BOND_CHECK_CACHE_SIZE)
+def check_bonds(components: ComponentCache, ligand: str, atom_names: frozenset[str], ring: Ring) -> bool | None:
+    # are_bonds_correct depends only on the set of atom names, so the result is shared by all patterns
+    # of the same ligand with the same atoms, None if the ligand is not in the dictionary
+    atom_bonds = components.get_bonds(ligand)
+    if atom_bonds is None:
+        return None
+    return are_bonds_correct(atom_names, atom_bonds, ring)
+
+
+def place_pattern(filepath: str, new_name_path: str, output_mode: str) -> None:
+    # a hardlink shares the data with the pattern found by PatternQuery, the file is copied
+    # when the link cannot be created (e.g. the output is on another filesystem)
+    if os.path.lexists(new_name_path):
+        # the file can be a link to the pattern itself left by a previous run
+        os.remove(new_name_path)
+    if output_mode == "hardlink":
+        try:
+            os.link(filepath, new_name_path)
+            return
+        except OSError:
+            pass
+    shutil.copy(filepath, new_name_path)
+
+
+def filter_pattern(filepath: str, ring: Ring, output_dir: str, components: ComponentCache,
+                   output_mode: str = "copy") -> tuple[str, bool | None, str | None, bool, dict[str, list] | None]:
+    # copies the pattern with correct bonds to the output directory, returns the ligand, the result of the bond check,
+    # the name of the copied file (None if the pattern was rejected), whether the bond check was memoized
+    # and the atoms of the pattern for the ring archive (None unless the output mode is archive)
+    ligand, atom_names = get_data_from_pdb(Path(filepath), ring)
+    hits = check_bonds.cache_info().hits
+    bonds_correct = check_bonds(components, ligand, frozenset(atom_names), ring)
+    cached = check_bonds.cache_info().hits > hits
+
+    if not bonds_correct:
+        return ligand, bonds_correct, None, cached, None
+
+    output_pdb_dir = os.path.join(output_dir, ligand, 'patterns')
+
+    # ligand name can be up to 3 chars
+    if os.path.basename(filepath)[len(ligand)] != '_':
+        new_name_path = os.path.join(output_pdb_dir,
+                                     ligand + '_' + os.path.basename(filepath))
+    else:
+        new_name_path = os.path.join(output_pdb_dir, os.path.basename(filepath))
+    if output_mode == "archive":
+        return ligand, bonds_correct, os.path.basename(new_name_path), cached, read_pattern_atoms(filepath)
+
+    os.makedirs(output_pdb_dir, exist_ok=True)
+    place_pattern(filepath, new_name_path, output_mode)
+    return ligand, bonds_correct, os.path.basename(new_name_path), cached, None
+
+
+# state of a worker process, every worker opens its own read-only connection to the components cache
+worker_state = {}
+
+
+def init_worker(ring: Ring, output_dir: str, path_to_cache: Path, output_mode: str) -> None:
+    worker_state["ring"] = ring
+    worker_state["output_dir"] = output_dir
+    worker_state["output_mode"] = output_mode
+    worker_state["components"] = ComponentCache(path_to_cache)
+
+
+def filter_pattern_in_worker(filepath: str) -> tuple[str, str, bool | None, str | None, bool, dict[str, list] | None]:
+    return filepath, *filter_pattern(filepath, worker_state["ring"], worker_state["output_dir"],
+                                     worker_state["components"], worker_state["output_mode"])
+
+
+def run_filter(input_dir: str, ring: Ring, output_dir: str, components: ComponentCache, jobs: int = 1,
+               output_mode: str = "copy") -> None:
+    filepaths = [os.path.join(root, file) for root, _, files in os.walk(input_dir)
+                 for file in files if file.endswith('.pdb')]
     target_count = 0
-
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if not file.endswith('.pdb'):
-                continue
-            total += 1
-            filepath = os.path.join(root, file)
-            ligand, atom_names = get_data_from_pdb(Path(filepath), ring)
-            ligand_block = document.find_block(ligand)
-
-            if ligand_block is None:
-                logging.warning(f"Ligand_block is None for {ligand}")
-                continue
-
-            atom_bonds = get_bonds_from_cif(ligand_block)
-
-            if are_bonds_correct(atom_names, atom_bonds, ring):
-                output_pdb_dir = os.path.join(output_dir, ligand, 'patterns')
-                os.makedirs(output_pdb_dir, exist_ok=True)
-
-                # ligand name can be up to 3 chars
-                if os.path.basename(filepath)[len(ligand)] != '_':
-                    new_name_path = os.path.join(output_pdb_dir,
-                                                 ligand + '_' + os.path.basename(filepath))
-                else:
-                    new_name_path = os.path.join(output_pdb_dir, os.path.basename(filepath))
-                logging.info(f"Copying {os.path.basename(filepath)}")
-                shutil.copy(filepath, new_name_path)
+    cache_hits = 0
+
+    # the archive replaces filtered_ligands, an archive of a previous run would be read instead of the patterns
+    path_to_archive = os.path.join(os.path.dirname(output_dir), RING_ARCHIVE)
+    # accepted rings are written to the archive as they come, they are not kept in memory
+    archive = RingArchiveWriter(path_to_archive) if output_mode == "archive" else nullcontext()
+
+    initargs = (ring, output_dir, components.path, output_mode)
+    with archive, Pool(jobs, initializer=init_worker, initargs=initargs) if jobs > 1 else nullcontext() as pool:
+        if pool is None:
+            results = ((filepath, *filter_pattern(filepath, ring, output_dir, components, output_mode))
+                       for filepath in filepaths)
+        else:
+            results = pool.imap_unordered(filter_pattern_in_worker, filepaths, chunksize=CHUNK_SIZE)
+
+        # results of the workers are logged and counted here
+        for filepath, ligand, bonds_correct, new_name, cached, atoms in results:
+            cache_hits += cached
+            if new_name is not None:
+                logging.info(f"{OUTPUT_MODE_ACTIONS[output_mode]} {os.path.basename(filepath)}")
                 target_count += 1
+                if atoms is not None:
+                    # pdb id is the second part of the name of the pattern (e.g. ABC_1abc_1.pdb)
+                    archive.add(f"{ligand}/patterns/{new_name}", ligand, new_name.split('_')[1], atoms)
+            elif bonds_correct is None:
+                logging.warning(f"Ligand_block is None for {ligand}")
 
-    logging.info(f"[{ring.name.capitalize()}]: {target_count} patterns were found.")
+    if output_mode == "archive":
+        logging.info(f"[{ring.name.capitalize()}]: Patterns were written to {path_to_archive}")
+    elif os.path.exists(path_to_archive):
+        shutil.rmtree(path_to_archive)
+        logging.info(f"[{ring.name.capitalize()}]: Ring archive of a previous run {path_to_archive} was removed")
 
+    logging.info(f"[{ring.name.capitalize()}]: {target_count} of {len(filepaths)} patterns were found.")
+    if filepaths:
+        logging.info(f"[{ring.name.capitalize()}]: Bond check cache hits: {cache_hits}, misses: "
+                     f"{len(filepaths) - cache_hits} (hit rate {100 * cache_hits / len(filepaths):.1f} %).")
 
-def main(ring: str, output_path: str, input_path: str):
+
+def main(rings: list[str], output_path: str, input_path: str, jobs: int = 1, output_mode: str = "copy"):
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s'
                         )
 
-    ring = ring.upper()
-    if ring not in Ring.__members__.keys():
-        logging.error(f"Ring {ring} is not a valid Ring. Currently supported: {[e.name for e in Ring]} Exiting...")
-        sys.exit(1)
+    rings = [ring.upper() for ring in rings]
+    if rings == ['ALL']:
+        rings = [e.name for e in Ring]
+    for ring in rings:
+        if ring not in Ring.__members__.keys():
+            logging.error(f"Ring {ring} is not a valid Ring. Currently supported: {[e.name for e in Ring]} Exiting...")
+            sys.exit(1)
 
-    logging.info(f"[{ring.capitalize()}]: Starting FilterDataset...")
+    for ring in rings:
+        logging.info(f"[{ring.capitalize()}]: Starting FilterDataset...")
 
     main_workflow_output_dir = os.path.join(output_path, MAIN_DIR)
     if not os.path.exists(main_workflow_output_dir):
@@ -64,25 +158,29 @@ def main(ring: str, output_path: str, input_path: str):
         sys.exit(1)
 
     path_to_comp_dict = os.path.join(input_path, DEFAULT_DICT_NAME)
-    logging.info('Reading components dictionary...')
     if not os.path.exists(path_to_comp_dict):
         logging.error(f"The file {path_to_comp_dict} does not exist. Exiting...")
         sys.exit(1)
 
-    current_ring_path = os.path.join(main_workflow_output_dir, ring.lower())
+    for ring in rings:
+        # that is the output dir from the previous script (previous step)
+        dir_with_patterns = os.path.join(main_workflow_output_dir, "result", ring.lower())
 
-    # that is the output dir from the previous script (previous step)
-    dir_with_patterns = os.path.join(main_workflow_output_dir, "result", ring.lower())
+        if not os.path.exists(dir_with_patterns) or not os.listdir(dir_with_patterns):
+            logging.error(f'The directory "{dir_with_patterns}" does not exist or is empty')
+            sys.exit(1)
 
-    if not os.path.exists(dir_with_patterns) or not os.listdir(dir_with_patterns):
-        logging.error(f'The directory "{dir_with_patterns}" does not exist or is empty')
-        sys.exit(1)
+    # the dictionary is read only once for all the rings, and only if its cache is missing or outdated
+    components = open_component_cache(Path(path_to_comp_dict), Path(input_path) / COMPONENTS_CACHE,
+                                      fallback_cache=Path(main_workflow_output_dir) / COMPONENTS_CACHE)
 
-    dir_for_filtered_patterns = os.path.join(current_ring_path, 'filtered_ligands')
+    for ring in rings:
+        current_ring_path = os.path.join(main_workflow_output_dir, ring.lower())
+        dir_with_patterns = os.path.join(main_workflow_output_dir, "result", ring.lower())
+        dir_for_filtered_patterns = os.path.join(current_ring_path, 'filtered_ligands')
 
-    document = cif.read(path_to_comp_dict)
-    run_filter(dir_with_patterns, Ring[ring], dir_for_filtered_patterns, document)
-    logging.info(f'[{ring.capitalize()}]: FilterDataset has completed successfully')
+        run_filter(dir_with_patterns, Ring[ring], dir_for_filtered_patterns, components, jobs, output_mode)
+        logging.info(f'[{ring.capitalize()}]: FilterDataset has completed successfully')
 
 
 if __name__ == '__main__':
@@ -90,14 +188,26 @@ if __name__ == '__main__':
                                         "the required atomic bonds")
     required = parser.add_argument_group('required named arguments')
 
-    required.add_argument('-r', '--ring', required=True, type=str,
-                          help=f'Choose the target ring type. Currently supported:'
+    required.add_argument('-r', '--ring', required=True, type=str, nargs='+',
+                          help=f'Choose the target ring types, or "all" to filter all of them in one run '
+                               f'(the components dictionary is read only once). Currently supported:'
                                f' {[e.name for e in Ring]}')
     required.add_argument('-o', '--output', type=str, required=True,
                           help='Path to the output directory. Should be the same as in the previous step.')
     required.add_argument('-i', '--input', type=str, required=True,
                           help='Path to the directory with input data (local pdb, ccp4 files, etc.)')
 
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes used for filtering (default: 1)')
+
+    parser.add_argument('-m', '--output-mode', choices=OUTPUT_MODES, default="copy",
+                        help='How the accepted patterns are written to filtered_ligands. "hardlink" links them to '
+                             'the PatternQuery results instead of copying them (falls back to copying when the '
+                             'output is on another filesystem), "archive" packs them to a single '
+                             f'{RING_ARCHIVE} directory per ring type instead of filtered_ligands, default: copy')
+
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('number of jobs cannot be lower than one')
 
-    main(args.ring, args.output, args.input)
+    main(args.ring, args.output, args.input, args.jobs, args.output_mode)
@@ -0,0 +1,153 @@
+import logging
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+from gemmi import cif
+
+from HelperModule.helper_functions import read_component_dictionary
+
+# increase when the layout of the cache changes
+CACHE_VERSION = 2
+
+BOND_TAGS = ['_chem_comp_bond.atom_id_1', '_chem_comp_bond.atom_id_2',
+             '_chem_comp_bond.value_order', '_chem_comp_bond.pdbx_aromatic_flag']
+ATOM_TAGS = ['_chem_comp_atom.atom_id', '_chem_comp_atom.type_symbol']
+
+
+# Compact projection of the Chemical Component Dictionary stored in SQLite. Only the atoms, bonds and the names
+# used by the workflow are kept, keyed by the name of the block (i.e. _chem_comp.id). Values are stored
+# as they are read from the dictionary by gemmi.
+class ComponentCache:
+    def __init__(self, path_to_cache: Path):
+        self.path = path_to_cache
+        self.connection = sqlite3.connect(f"file:{path_to_cache}?mode=ro", uri=True)
+
+    def has_component(self, ligand: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM components WHERE block = ?", (ligand,)).fetchone() is not None
+
+    def get_bonds(self, ligand: str) -> list[list[str]] | None:
+        # the same rows as get_bonds_from_cif, None if the ligand is not in the dictionary
+        if not self.has_component(ligand):
+            return None
+        rows = self.connection.execute("SELECT atom_id_1, atom_id_2, value_order, aromatic_flag FROM bonds "
+                                       "WHERE block = ? ORDER BY position", (ligand,))
+        return [list(row) for row in rows]
+
+    def get_blocks(self) -> list[str]:
+        # names of the blocks of all the components in the order of the dictionary
+        return [row[0] for row in self.connection.execute("SELECT block FROM components ORDER BY position")]
+
+    def get_atoms_of_element(self, ligand: str, element: str) -> set[str]:
+        # names of the atoms of the element (_chem_comp_atom.type_symbol) without quotes, as in are_bonds_correct
+        rows = self.connection.execute("SELECT atom_id FROM atoms WHERE block = ? AND type_symbol = ?",
+                                       (ligand, element))
+        return {row[0].strip('"') for row in rows}
+
+    def get_name_columns(self) -> tuple[list[str | None], list[str | None]]:
+        # _chem_comp.id and the lowercase names of all the components in the order of the dictionary. The names
+        # of a component (_chem_comp.name, _chem_comp.pdbx_synonyms and identifiers) are joined by newlines,
+        # None when the name or the synonyms are missing.
+        comp_ids, names = [], []
+        for comp_id, name, synonyms, identifiers in self.connection.execute(
+                "SELECT comp_id, name, synonyms, (SELECT group_concat(identifier, char(10)) FROM identifiers "
+                "WHERE identifiers.block = components.block) FROM components ORDER BY position"):
+            comp_ids.append(comp_id)
+            if name is None or synonyms is None:
+                names.append(None)
+            else:
+                names.append("\n".join([name, synonyms] + ([identifiers] if identifiers is not None else [])).lower())
+        return comp_ids, names
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def get_source_stamp(path_to_comp_dict: Path) -> str:
+    stat = path_to_comp_dict.stat()
+    return f"{CACHE_VERSION};{stat.st_size};{stat.st_mtime_ns}"
+
+
+def build_component_cache(document: cif.Document, path_to_cache: Path, source_stamp: str) -> None:
+    logging.info(f"Building components cache {str(path_to_cache)}...")
+    temporary_path = path_to_cache.with_name(f"{path_to_cache.name}.{os.getpid()}.tmp")
+    if temporary_path.exists():
+        os.remove(temporary_path)
+
+    try:
+        write_component_cache(document, temporary_path, source_stamp)
+        os.replace(temporary_path, path_to_cache)
+    finally:
+        if temporary_path.exists():
+            os.remove(temporary_path)
+
+
+def write_component_cache(document: cif.Document, path_to_cache: Path, source_stamp: str) -> None:
+    connection = sqlite3.connect(path_to_cache)
+    connection.executescript("""
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE components (block TEXT PRIMARY KEY, position INTEGER, comp_id TEXT, name TEXT, synonyms TEXT);
+        CREATE TABLE identifiers (block TEXT, position INTEGER, identifier TEXT);
+        CREATE TABLE atoms (block TEXT, position INTEGER, atom_id TEXT, type_symbol TEXT);
+        CREATE TABLE bonds (block TEXT, position INTEGER, atom_id_1 TEXT, atom_id_2 TEXT, value_order TEXT,
+                            aromatic_flag TEXT);
+    """)
+    for i, ligand_block in enumerate(document):
+        connection.execute("INSERT OR IGNORE INTO components VALUES (?, ?, ?, ?, ?)",
+                           (ligand_block.name, i, ligand_block.find_value('_chem_comp.id'),
+                            ligand_block.find_value('_chem_comp.name'),
+                            ligand_block.find_value('_chem_comp.pdbx_synonyms')))
+        connection.executemany("INSERT INTO identifiers VALUES (?, ?, ?)",
+                               [(ligand_block.name, j, identifier[0]) for j, identifier
+                                in enumerate(ligand_block.find(['_pdbx_chem_comp_identifier.identifier']))])
+        connection.executemany("INSERT INTO atoms VALUES (?, ?, ?, ?)",
+                               [(ligand_block.name, j, *atom) for j, atom in enumerate(ligand_block.find(ATOM_TAGS))])
+        connection.executemany("INSERT INTO bonds VALUES (?, ?, ?, ?, ?, ?)",
+                               [(ligand_block.name, j, *bond) for j, bond in enumerate(ligand_block.find(BOND_TAGS))])
+
+    connection.execute("CREATE INDEX identifiers_block ON identifiers (block)")
+    connection.execute("CREATE INDEX atoms_block ON atoms (block)")
+    connection.execute("CREATE INDEX bonds_block ON bonds (block)")
+    connection.execute("INSERT INTO meta VALUES ('source', ?)", (source_stamp,))
+    connection.commit()
+    connection.close()
+
+
+def is_cache_valid(path_to_cache: Path, source_stamp: str) -> bool:
+    if not path_to_cache.exists():
+        return False
+    try:
+        connection = sqlite3.connect(f"file:{path_to_cache}?mode=ro", uri=True)
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+    return row is not None and row[0] == source_stamp
+
+
+def open_component_cache(path_to_comp_dict: Path, path_to_cache: Path,
+                         document: cif.Document | None = None,
+                         fallback_cache: Path | None = None) -> ComponentCache:
+    # The cache is (re)built from the dictionary when it is missing or the dictionary has changed,
+    # otherwise the dictionary does not have to be read at all. When path_to_cache cannot be written
+    # (e.g. the input data are read-only), the cache is kept at fallback_cache instead.
+    source_stamp = get_source_stamp(path_to_comp_dict)
+    paths_to_cache = [path_to_cache] if fallback_cache is None else [path_to_cache, fallback_cache]
+    for path in paths_to_cache:
+        if is_cache_valid(path, source_stamp):
+            logging.info(f"Using components cache {str(path)}.")
+            return ComponentCache(path)
+
+    if document is None:
+        document = read_component_dictionary(path_to_comp_dict)
+    for path in paths_to_cache:
+        try:
+            build_component_cache(document, path, source_stamp)
+            return ComponentCache(path)
+        except (sqlite3.Error, OSError) as e:
+            logging.warning(f"Components cache {str(path)} could not be written: {e}")
+    logging.error(f"Components cache could not be written to any of {[str(path) for path in paths_to_cache]}.")
+    sys.exit('Exiting...')
@@ -2,12 +2,15 @@ import os
 from pathlib import Path
 
 PQ_CONFIG = "config.json"
+PQ_SHARDS_DIR = "shards"
 MAIN_DIR = "validation_data"
 DEFAULT_DICT_NAME = 'components.cif.gz'
+COMPONENTS_CACHE = 'components_cache.sqlite'
 CCP4_DIR = 'ccp4'
 PDB = 'pdb_copy_local'
 PDB_INFO_FILE = 'PDB_information.csv'
 FILTERED_DATA = "filtered_ligands"
+RING_ARCHIVE = "filtered_ligands_archive"
 TEMPLATES_DIR = "templates"
 SB_AVG = Path("SiteBinderCMD_avg") / "SiteBinderCMD.exe"
 PQ_CMD = Path("PatternQuery_1.1.23.12.27b") / "WebChemistry.Queries.Service.exe"
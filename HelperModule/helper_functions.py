@@ -3,8 +3,10 @@ import logging
 import os
 import shutil
 import sys
+import zlib
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 
 from gemmi import cif
 
@@ -51,16 +53,87 @@ def are_bonds_correct(atom_names, bonds, ring: Ring):
     return False
 
 
-def unzip_file(src: Path, dst: Path) -> None:
+def find_rings(atom_names, bonds, size: int) -> list[frozenset[str]]:
+    # all simple cycles of the given size in the graph of the bonds between the given atoms
+    neighbours = {}
+    for bond in bonds:
+        atom_1, atom_2 = bond[0].strip('"'), bond[1].strip('"')
+        if atom_1 in atom_names and atom_2 in atom_names and atom_1 != atom_2:
+            neighbours.setdefault(atom_1, set()).add(atom_2)
+            neighbours.setdefault(atom_2, set()).add(atom_1)
+
+    # every cycle is walked from its first atom in this order only, once in each direction
+    order = {atom: i for i, atom in enumerate(sorted(neighbours))}
+    rings = set()
+
+    def extend(path: list[str]) -> None:
+        for neighbour in neighbours[path[-1]]:
+            if neighbour == path[0] and len(path) == size:
+                rings.add(frozenset(path))
+            elif len(path) < size and neighbour not in path and order[neighbour] > order[path[0]]:
+                extend(path + [neighbour])
+
+    for atom in neighbours:
+        extend([atom])
+    return list(rings)
+
+
+def file_crc32(path: Path) -> int:
+    crc = 0
+    with open(path, "rb") as file:
+        while chunk := file.read(1 << 20):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_written(member: ZipInfo, dst: Path) -> bool:
+    path = Path(dst) / member.filename
+    if member.is_dir():
+        return path.is_dir()
+    return path.is_file() and path.stat().st_size == member.file_size
+
+
+def is_extracted(member: ZipInfo, dst: Path) -> bool:
+    # the member was extracted by a previous (possibly interrupted) extraction, files of the same size
+    # are common in fixed-width formats, so the content of the file has to match the member
+    return is_written(member, dst) and (member.is_dir() or file_crc32(Path(dst) / member.filename) == member.CRC)
+
+
+def extract_members(src: Path, dst: Path, members: list[ZipInfo]) -> None:
+    with ZipFile(src, "r") as zip_obj:
+        for member in members:
+            zip_obj.extract(member, dst)
+
+
+def unzip_file(src: Path, dst: Path, jobs: int = 1) -> bool:
+    # members are extracted by jobs threads, every thread reads the archive on its own. Returns whether all
+    # the members were extracted, the archive is removed only then.
     try:
         if not src.exists():
             raise FileNotFoundError(f"Source file for unzipping not found: {str(src)}")
 
         with ZipFile(src, "r") as zip_obj:
-            zip_obj.extractall(dst)
+            all_members = zip_obj.infolist()
+        members = [member for member in all_members if not is_extracted(member, dst)]
+        # directories are created beforehand, so that the threads do not race to create them
+        for directory in {(Path(dst) / member.filename).parent for member in members}:
+            os.makedirs(directory, exist_ok=True)
+
+        if jobs > 1 and len(members) > 1:
+            with ThreadPool(jobs) as pool:
+                pool.starmap(extract_members, [(src, dst, members[i::jobs]) for i in range(jobs)])
+        else:
+            extract_members(src, dst, members)
+
+        # extracted members were checked against their CRC by ZipFile, the skipped ones by is_extracted
+        missing = [member.filename for member in all_members if not is_written(member, dst)]
+        if missing:
+            raise OSError(f"{len(missing)} members of {str(src)} were not extracted, e.g. {missing[0]}")
         os.remove(src)
+        return True
     except Exception as e:
         logging.error(f"An error occurred during extraction: {e}")
+        return False
 
 
 def is_mono_installed():
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from HelperModule.constants import FILTERED_DATA
+
+# increase when the layout of the archive changes
+ARCHIVE_VERSION = 2
+# number of rings buffered by RingArchiveWriter before their atoms are written
+WRITE_CHUNK_SIZE = 4096
+
+ATOM_COLUMNS = ("serials", "atom_names", "altlocs", "residues", "elements", "occupancies", "coordinates")
+ATOM_DTYPES = {"serials": np.int64,
+               "atom_names": "U4",
+               "altlocs": "U1",
+               "residues": "U10",
+               "elements": "U2",
+               "occupancies": np.float64,
+               "coordinates": np.float64}
+# shape of the values of one atom
+ATOM_SHAPES = {"coordinates": (3,)}
+
+
+def read_pattern_atoms(path_to_pdb: Path | str) -> dict[str, list]:
+    # all atoms of the first model of a pattern PDB file in the order of the file,
+    # the element is guessed from the atom name when the element column is empty
+    atoms = {column: [] for column in ATOM_COLUMNS}
+    with open(path_to_pdb, 'r') as file:
+        for line in file:
+            if line.startswith("ENDMDL"):
+                break
+            if not line.startswith(("ATOM  ", "HETATM")):
+                continue
+            element = line[76:78].strip().upper()
+            if not element:
+                # Hs may have digit at the first position
+                element = line[12:16].strip().lstrip("0123456789")[:1].upper()
+            atoms["serials"].append(int(line[6:11]) if line[6:11].strip() else 0)
+            atoms["atom_names"].append(line[12:16].strip())
+            atoms["altlocs"].append(line[16].strip())
+            atoms["residues"].append(line[17:27])
+            atoms["elements"].append(element)
+            atoms["occupancies"].append(float(line[54:60]) if line[54:60].strip() else 1.0)
+            atoms["coordinates"].append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return atoms
+
+
+def is_ring_archive(path: Path | str) -> bool:
+    return (Path(path) / "version.npy").is_file()
+
+
+# Writer of the ring archive, a directory with one .npy file per column.
+# Atoms are appended to raw column files in chunks while the rings are added, the .npy columns are written
+# when the archive is closed with the rings sorted by name, atoms of the i-th ring are offsets[i]:offsets[i + 1].
+class RingArchiveWriter:
+    def __init__(self, path_to_archive: Path | str):
+        self.path = Path(path_to_archive)
+        self.temporary_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        if self.temporary_path.exists():
+            shutil.rmtree(self.temporary_path)
+        os.makedirs(self.temporary_path)
+        self.names = []
+        self.ligands = []
+        self.pdb_ids = []
+        self.sizes = []
+        self.buffer = []
+        self.files = {column: open(self.temporary_path / f"{column}.bin", "wb") for column in ATOM_COLUMNS}
+
+    def __enter__(self) -> "RingArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def add(self, name: str, ligand: str, pdb_id: str, atoms: dict[str, list]) -> None:
+        # the name is the path of the pattern relative to filtered_ligands
+        self.names.append(name)
+        self.ligands.append(ligand)
+        self.pdb_ids.append(pdb_id)
+        self.sizes.append(len(atoms["serials"]))
+        self.buffer.append(atoms)
+        if len(self.buffer) >= WRITE_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        for column in ATOM_COLUMNS:
+            values = [value for atoms in self.buffer for value in atoms[column]]
+            np.array(values, dtype=ATOM_DTYPES[column]).tofile(self.files[column])
+        self.buffer = []
+
+    def write_column(self, column: str, order: np.ndarray, offsets: np.ndarray, sorted_offsets: np.ndarray) -> None:
+        # atoms of the rings are copied from the raw file to the .npy file in the order of the rings
+        shape = (int(offsets[-1]), *ATOM_SHAPES.get(column, ()))
+        raw_path = self.temporary_path / f"{column}.bin"
+        npy_path = self.temporary_path / f"{column}.npy"
+        if shape[0] == 0:
+            np.save(npy_path, np.empty(shape, dtype=ATOM_DTYPES[column]))
+        else:
+            source = np.memmap(raw_path, dtype=ATOM_DTYPES[column], mode="r", shape=shape)
+            target = np.lib.format.open_memmap(npy_path, mode="w+", dtype=ATOM_DTYPES[column], shape=shape)
+            for start in range(0, len(order), WRITE_CHUNK_SIZE):
+                rings = order[start:start + WRITE_CHUNK_SIZE]
+                sizes = offsets[rings + 1] - offsets[rings]
+                # indices of the atoms of the rings, offsets[ring] + 0, 1, ..., size - 1 for every ring
+                indices = np.repeat(offsets[rings] - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+                target[sorted_offsets[start]:sorted_offsets[start + len(rings)]] = source[indices]
+            target.flush()
+            del source, target
+        os.remove(raw_path)
+
+    def close(self) -> None:
+        self.flush()
+        for file in self.files.values():
+            file.close()
+
+        names = np.array(self.names, dtype=str)
+        order = np.argsort(names, kind="stable")
+        sizes = np.array(self.sizes, dtype=np.int64)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        sorted_offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        sorted_offsets[1:] = np.cumsum(sizes[order])
+        for column in ATOM_COLUMNS:
+            self.write_column(column, order, offsets, sorted_offsets)
+        np.save(self.temporary_path / "names.npy", names[order])
+        np.save(self.temporary_path / "ligands.npy", np.array(self.ligands, dtype=str)[order])
+        np.save(self.temporary_path / "pdb_ids.npy", np.array(self.pdb_ids, dtype=str)[order])
+        np.save(self.temporary_path / "offsets.npy", sorted_offsets)
+        # version is written last, a directory without it is not a complete archive
+        np.save(self.temporary_path / "version.npy", np.array(ARCHIVE_VERSION))
+
+        # the archive of a previous run is moved away first, a directory cannot be replaced by os.replace
+        previous_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.old")
+        if self.path.exists():
+            os.rename(self.path, previous_path)
+        os.rename(self.temporary_path, self.path)
+        if previous_path.exists():
+            shutil.rmtree(previous_path)
+
+    def discard(self) -> None:
+        for file in self.files.values():
+            file.close()
+        shutil.rmtree(self.temporary_path, ignore_errors=True)
+
+
+# Packed rings of one ring type written by FilterDataset, replaces the pattern files in filtered_ligands.
+# Columns are memory-mapped, atoms are read from the disk only for the rings which are used.
+class RingArchive:
+    def __init__(self, path_to_archive: Path | str):
+        self.path = Path(path_to_archive)
+        version = int(np.load(self.path / "version.npy"))
+        if version != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported version of ring archive {path_to_archive}: {version}")
+        self.names = self.load("names")
+        self.ligands = self.load("ligands")
+        self.pdb_ids = self.load("pdb_ids")
+        self.offsets = self.load("offsets")
+        self.columns = {column: self.load(column) for column in ATOM_COLUMNS}
+        # rings are named as their files would be in filtered_ligands next to the archive
+        self.rings_dir = self.path.parent / FILTERED_DATA
+
+    def load(self, column: str) -> np.ndarray:
+        return np.load(self.path / f"{column}.npy", mmap_mode="r", allow_pickle=False)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get_atoms(self, name: str) -> dict[str, np.ndarray]:
+        # names are sorted, the ring is found by binary search
+        i = int(np.searchsorted(self.names, name))
+        if i == len(self.names) or self.names[i] != name:
+            raise KeyError(name)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {column: values[start:end] for column, values in self.columns.items()}
+
+    def get_content_hash(self, name: str) -> str:
+        # counterpart of the hash of a pattern file for incremental runs
+        atoms = self.get_atoms(name)
+        return hashlib.sha256(b"".join(np.ascontiguousarray(atoms[column]).tobytes()
+                                       for column in ATOM_COLUMNS)).hexdigest()
+
+    def close(self) -> None:
+        # memory maps are closed when the arrays are released
+        self.names = self.ligands = self.pdb_ids = self.offsets = None
+        self.columns = {}
@@ -1,62 +1,100 @@
 import re
 from argparse import ArgumentParser
 from HelperModule.Ring import Ring
-from HelperModule.helper_functions import (unzip_file, is_mono_installed,
-                                           read_component_dictionary, is_valid_directory, file_exists)
+from HelperModule.helper_functions import unzip_file, is_mono_installed, is_valid_directory, file_exists, \
+    are_bonds_correct, find_rings
+from HelperModule.component_cache import ComponentCache, open_component_cache
 from HelperModule.constants import *
 import logging
-from gemmi import cif
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from typing import Dict, List
 import json
 import subprocess
 import os
 import sys
+import time
+import zlib
+import numpy as np
 
 CPU_COUNT = cpu_count()
 
 
-def is_target_ring_in_name(ring: Ring, all_names: list[str]) -> bool:
-    if ring is Ring.BENZENE:
+# amino acids with rings in their names are not ligands
+EXCLUDED_LIGANDS = ('PHE', 'TYR', 'TRP')
+# separates the names of components in the text scanned for the ring substrings, it is not in any of them
+NAME_SEPARATOR = '\0'
+# how the candidate ligands for PatternQuery are selected from the components dictionary
+PRESELECTION_MODES = ("names", "structure")
+# input of a shard of PatternQuery, links to the files of pdb_copy_local
+SHARD_INPUT_DIR = "input"
+# written to the directory of a shard when its results were extracted
+SHARD_COMPLETED = "completed.json"
 
-        # we need to check both 'benz' and 'phen'
-        substrings = ring.name_substring.split(';')
 
-        for substring in substrings:
-            if any(substring in e for e in all_names):
-                return True
+def get_name_pattern(ring: Ring) -> re.Pattern:
+    # substrings of benzene are separated by ';' (we need to check both 'benz' and 'phen')
+    return re.compile('|'.join(re.escape(substring) for substring in ring.name_substring.split(';')))
 
-    return any(ring.name_substring in e for e in all_names)
 
-
-def extract_ligand_names(doc: cif.Document) -> Dict[Ring, List[str]]:
+def extract_ligand_names(components: ComponentCache) -> Dict[Ring, List[str]]:
     logging.info("Extracting ligand names...")
-    extracted_names = {ring: [] for ring in Ring}
-    for i, ligand_block in enumerate(doc):
-        compound_name = ligand_block.find_value('_chem_comp.name')  # chemical name
-        try:
-            other_names = ligand_block.find(['_pdbx_chem_comp_identifier.identifier'])
-            synonyms = ligand_block.find_value('_chem_comp.pdbx_synonyms')
-
-            all_names = [compound_name.lower()] + [list(e)[0].lower() for e in list(other_names)] + \
-                        [synonyms.lower()]
+    start = time.perf_counter()
+    ligand_names, names = components.get_name_columns()
+
+    # components without a name or synonyms are skipped
+    for ligand_name, component_names in zip(ligand_names, names):
+        if component_names is None:
+            logging.warning(f'Error while extracting ligand names from block with name {ligand_name}. Skipping...')
+    is_candidate = np.array([component_names is not None and str(ligand_name) not in EXCLUDED_LIGANDS
+                             for ligand_name, component_names in zip(ligand_names, names)], dtype=bool)
+
+    # the names of all the components are scanned at once, matches are mapped back to the components by offsets
+    names = [component_names if component_names is not None else '' for component_names in names]
+    text = NAME_SEPARATOR.join(names)
+    offsets = np.cumsum([len(component_names) + len(NAME_SEPARATOR) for component_names in names])
+    logging.info(f"Names of {len(names)} components were read in {time.perf_counter() - start:.2f} s.")
+
+    extracted_names = {}
+    for ring in Ring:
+        start = time.perf_counter()
+        match_positions = np.fromiter((match.start() for match in get_name_pattern(ring).finditer(text)),
+                                      dtype=np.int64)
+        matched = np.zeros(len(names), dtype=bool)
+        matched[np.searchsorted(offsets, match_positions, side='right')] = True
+        extracted_names[ring] = [ligand_names[i] for i in np.flatnonzero(matched & is_candidate)]
+        logging.info(f"[{ring.name.capitalize()}]: {len(extracted_names[ring])} ligands were found "
+                     f"in {time.perf_counter() - start:.2f} s.")
 
-            ligand_name = ligand_block.find_value('_chem_comp.id')
-
-            # if len(ligand_name) > 3:
-            #     logging.warning(f"The ligand name is longer than allowed three characters. Skipping {ligand_name}...")
-            #     continue
+    if not all(extracted_names.values()):
+        logging.warning('No rings found. Exiting...')
+        sys.exit(1)
 
-            if str(ligand_name) in ('PHE', 'TYR', 'TRP'):
-                continue
+    return extracted_names
 
-            for ring in Ring:
-                if is_target_ring_in_name(ring, all_names):
-                    extracted_names[ring].append(ligand_name)
 
-        except Exception:
-            logging.warning(f'Error while extracting ligand names from block with name {compound_name}. Skipping...')
+def extract_ligand_names_by_structure(components: ComponentCache) -> Dict[Ring, List[str]]:
+    # ligands with a ring of carbons whose bonds pass the same check as the patterns in FilterDataset
+    logging.info("Extracting ligands by structure...")
+    extracted_names = {ring: [] for ring in Ring}
+    elapsed = {ring: 0.0 for ring in Ring}
+    for ligand_name in components.get_blocks():
+        if ligand_name in EXCLUDED_LIGANDS:
             continue
+        carbons = components.get_atoms_of_element(ligand_name, 'C')
+        bonds = components.get_bonds(ligand_name)
+        rings_of_size = {}
+        for ring in Ring:
+            start = time.perf_counter()
+            if ring.atom_number not in rings_of_size:
+                rings_of_size[ring.atom_number] = find_rings(carbons, bonds, ring.atom_number)
+            if any(are_bonds_correct(atom_names, bonds, ring) for atom_names in rings_of_size[ring.atom_number]):
+                extracted_names[ring].append(ligand_name)
+            elapsed[ring] += time.perf_counter() - start
+
+    for ring in Ring:
+        logging.info(f"[{ring.name.capitalize()}]: {len(extracted_names[ring])} ligands were found "
+                     f"in {elapsed[ring]:.2f} s.")
 
     if not all(extracted_names.values()):
         logging.warning('No rings found. Exiting...')
@@ -65,19 +103,21 @@ def extract_ligand_names(doc: cif.Document) -> Dict[Ring, List[str]]:
     return extracted_names
 
 
-def create_config_for_pq(path_to_main_output: Path, path_to_pdb_local: str, ligands_dict: Dict[Ring, List[str]]) -> None:
+def create_queries(ligands_dict: Dict[Ring, List[str]]) -> List[Dict[str, str]]:
+    return [create_query(ring.name.lower(), ring.pattern_query + f".Inside(Residues({ligands}))")
+            for ring, ligands in ligands_dict.items()]
+
+
+def create_config_for_pq(path_to_main_output: Path, path_to_pdb_local: str, ligands_dict: Dict[Ring, List[str]],
+                         max_parallelism: int = CPU_COUNT) -> None:
     logging.info("Creating configuration file for Pattern Query...")
     config = {
         "InputFolders": [path_to_pdb_local],
-        "Queries": [],
+        "Queries": create_queries(ligands_dict),
         "StatisticsOnly": False,
-        "MaxParallelism": CPU_COUNT
+        "MaxParallelism": max_parallelism
     }
 
-    for ring, ligands in ligands_dict.items():
-        config["Queries"].append(create_query(ring.name.lower(), ring.pattern_query +
-                                              f".Inside(Residues({ligands}))"))
-
     try:
         with open(path_to_main_output / PQ_CONFIG, "w") as outfile:
             json.dump(config, outfile)
@@ -97,7 +137,8 @@ def create_query(query_id: str, query_string: str) -> Dict[str, str]:
     }
 
 
-def start_program(results_folder: Path, pq_cmd):
+def run_pattern_query(results_folder: Path, pq_cmd, name: str = "Pattern Query") -> bool:
+    # returns False when PatternQuery reports an error or fails, the process is stopped at the first error
     commands = {
         'posix': ['mono', pq_cmd],
         'nt': [pq_cmd]
@@ -106,19 +147,107 @@ def start_program(results_folder: Path, pq_cmd):
     command = commands.get(os.name, [])
     command.extend([results_folder, str(results_folder / PQ_CONFIG)])
 
-    logging.info(f"Running Pattern Query on CPU count: {CPU_COUNT}...")
-
     pq_process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
 
     for line in pq_process.stdout:
         error_pattern = r"^\[.*?\] Error:"
         if re.match(error_pattern, line):
-            logging.error(f"Error while running Pattern Query {line}")
-            sys.exit(1)
+            logging.error(f"Error while running {name} {line}")
+            pq_process.kill()
+            pq_process.wait()
+            return False
         print(line, end='')
 
+    return pq_process.wait() == 0
+
+
+def start_program(results_folder: Path, pq_cmd):
+    logging.info(f"Running Pattern Query on CPU count: {CPU_COUNT}...")
+
+    if not run_pattern_query(results_folder, pq_cmd):
+        sys.exit(1)
+
+
+def get_shard_dirs(path_to_main_output: Path, shards: int) -> List[Path]:
+    return [path_to_main_output / PQ_SHARDS_DIR / f"shard_{i:04d}" for i in range(shards)]
+
+
+def link_shard_inputs(path_to_pdb_local: Path, shard_dirs: List[Path], pending: List[Path]) -> None:
+    # files are assigned to the shards by the hash of their path, so the assignment does not depend
+    # on the other files. The files are hardlinked, or symlinked when it is not possible, to the same relative
+    # path as in the input, PatternQuery takes the structure id from the name of the file.
+    for shard_dir in pending:
+        os.makedirs(shard_dir / SHARD_INPUT_DIR, exist_ok=True)
+    pending = set(pending)
+
+    for root, _, files in os.walk(path_to_pdb_local):
+        for file in files:
+            filepath = Path(root) / file
+            relative_path = filepath.relative_to(path_to_pdb_local).as_posix()
+            shard_dir = shard_dirs[zlib.crc32(relative_path.encode()) % len(shard_dirs)]
+            if shard_dir not in pending:
+                continue
+            link_path = shard_dir / SHARD_INPUT_DIR / relative_path
+            if os.path.lexists(link_path):
+                continue
+            os.makedirs(link_path.parent, exist_ok=True)
+            try:
+                os.link(filepath, link_path)
+            except OSError:
+                os.symlink(filepath, link_path)
+
+
+def run_shard(shard_dir: Path) -> tuple[Path, bool]:
+    logging.info(f"Running Pattern Query for {shard_dir.name}...")
+    success = run_pattern_query(shard_dir, PQ_CMD, f"Pattern Query for {shard_dir.name}")
+    return shard_dir, success and (shard_dir / 'result' / 'result.zip').exists()
+
+
+def run_sharded(path_to_main_output: Path, path_to_pdb_local: Path, ligands_dict: Dict[Ring, List[str]],
+                shards: int, jobs: int, extract_jobs: int = 1) -> None:
+    # PatternQuery runs for every shard of the input separately, at most jobs shards at once. A shard is
+    # completed when its results are extracted to the result directory, so a failed or interrupted run resumes
+    # only the shards which were not completed. All the shards share the result directory, so a run with
+    # other shards or queries cannot be resumed.
+    shard_dirs = get_shard_dirs(path_to_main_output, shards)
+    completion = json.dumps({"Shards": shards, "Queries": create_queries(ligands_dict)})
+    completed = [shard_dir for shard_dir in (path_to_main_output / PQ_SHARDS_DIR).glob("shard_*")
+                 if (shard_dir / SHARD_COMPLETED).exists()]
+    if any((shard_dir / SHARD_COMPLETED).read_text() != completion for shard_dir in completed):
+        logging.error(f"Shards in {path_to_main_output / PQ_SHARDS_DIR} were completed with other shards or queries, "
+                      f"their results would be mixed in {path_to_main_output / 'result'}. "
+                      f"Use a new output directory.")
+        sys.exit(1)
+    pending = [shard_dir for shard_dir in shard_dirs if not (shard_dir / SHARD_COMPLETED).exists()]
+    logging.info(f"{len(shard_dirs) - len(pending)} of {shards} shards of Pattern Query are already completed.")
+
+    link_shard_inputs(path_to_pdb_local, shard_dirs, pending)
+    for shard_dir in pending:
+        create_config_for_pq(shard_dir, str(shard_dir / SHARD_INPUT_DIR), ligands_dict, max(1, CPU_COUNT // jobs))
+
+    failed = []
+    logging.info(f"Running Pattern Query for {len(pending)} shards, {jobs} at once...")
+    with ThreadPool(jobs) as pool:
+        # results of the shards are extracted one by one as the shards finish
+        for shard_dir, success in pool.imap_unordered(run_shard, pending):
+            if not success:
+                logging.error(f"Pattern Query for {shard_dir.name} has failed.")
+                failed.append(shard_dir.name)
+                continue
+            if not get_results(shard_dir / 'result' / 'result.zip', path_to_main_output / 'result', extract_jobs):
+                logging.error(f"Results of Pattern Query for {shard_dir.name} were not extracted.")
+                failed.append(shard_dir.name)
+                continue
+            (shard_dir / SHARD_COMPLETED).write_text(completion)
+            logging.info(f"Pattern Query for {shard_dir.name} has completed.")
+
+    if failed:
+        logging.error(f"Pattern Query has failed for {len(failed)} of {shards} shards: {failed}. "
+                      f"Run PrepareDataset again with the same arguments to resume them.")
+        sys.exit(1)
 
-def prerequisites_are_met(input_dir: str, output_dir: str) -> bool:
+
+def prerequisites_are_met(input_dir: str, output_dir: str, resume: bool = False) -> bool:
 
     input_path = Path(input_dir).resolve()
     if not is_valid_directory(input_dir):
@@ -147,6 +276,10 @@ def prerequisites_are_met(input_dir: str, output_dir: str) -> bool:
     try:
         os.makedirs(main_workflow_output_dir)
     except FileExistsError:
+        # a sharded run is resumed in the output directory of the previous run
+        if resume and (main_workflow_output_dir / PQ_SHARDS_DIR).is_dir():
+            logging.info(f"Resuming the sharded run in {main_workflow_output_dir}.")
+            return True
         logging.error(f"The directory {main_workflow_output_dir} already exists.")
         return False
     except PermissionError:
@@ -159,56 +292,61 @@ def prerequisites_are_met(input_dir: str, output_dir: str) -> bool:
     return True
 
 
-def get_results(src: Path, dst: Path):
-    # Unzipping the results from Pattern Query
+def get_results(src: Path, dst: Path, jobs: int = 1) -> bool:
+    # Unzipping the results from Pattern Query, returns whether they were extracted completely
     logging.info('Unzipping the results from Pattern Query...')
+    return unzip_file(src, dst, jobs)
+
 
+def unzip_all(path_to_archives: Path, jobs: int = 1) -> None:
+    # the archives are extracted by jobs threads at once
+    lst = list(path_to_archives.glob('*.zip'))
     try:
-        unzip_file(src, dst)
-    except FileNotFoundError as e:
-        logging.error(f"File with PQ results was not found: {e}.")
-        sys.exit(1)
+        with ThreadPool(jobs) as pool:
+            pool.starmap(unzip_file, [(zip_, path_to_archives) for zip_ in lst])
     except Exception as e:
         logging.error(str(e))
         sys.exit(1)
 
 
-def unzip_all(path_to_archives: Path) -> None:
-    lst = path_to_archives.glob('*.zip')
-    for zip_ in lst:
-        try:
-            unzip_file(zip_, path_to_archives)
-        except Exception as e:
-            logging.error(str(e))
-            sys.exit(1)
-
-
-def preprocess_data(data_path: Path) -> None:
-    unzip_all(data_path / PDB)
-    unzip_all(data_path / CCP4_DIR)
+def preprocess_data(data_path: Path, jobs: int = 1) -> None:
+    unzip_all(data_path / PDB, jobs)
+    unzip_all(data_path / CCP4_DIR, jobs)
 
 
-def main(input_path: str, output_path: str):
+def main(input_path: str, output_path: str, preselection: str = "names", shards: int = 1, jobs: int = 1,
+         extract_jobs: int = 1):
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s',
                         )
     logging.info('Starting PrepareDataset...')
-    if not prerequisites_are_met(input_path, output_path):
+    if not prerequisites_are_met(input_path, output_path, resume=shards > 1):
         sys.exit(1)
 
-    preprocess_data(Path(input_path).resolve())
-
-    document = read_component_dictionary(Path(input_path).resolve() / DEFAULT_DICT_NAME)
+    preprocess_data(Path(input_path).resolve(), extract_jobs)
 
     path_to_local_pdb = Path(input_path).resolve() / PDB
     main_workflow_output_dir = Path(output_path).resolve() / MAIN_DIR
 
-    ligands_dict = extract_ligand_names(document)
-    create_config_for_pq(main_workflow_output_dir, str(path_to_local_pdb), ligands_dict)
+    components = open_component_cache(Path(input_path).resolve() / DEFAULT_DICT_NAME,
+                                      Path(input_path).resolve() / COMPONENTS_CACHE,
+                                      fallback_cache=main_workflow_output_dir / COMPONENTS_CACHE)
+
+    if preselection == "structure":
+        ligands_dict = extract_ligand_names_by_structure(components)
+    else:
+        ligands_dict = extract_ligand_names(components)
 
-    start_program(main_workflow_output_dir, pq_cmd=PQ_CMD)
+    if shards > 1:
+        run_sharded(main_workflow_output_dir, path_to_local_pdb, ligands_dict, shards, jobs, extract_jobs)
+    else:
+        create_config_for_pq(main_workflow_output_dir, str(path_to_local_pdb), ligands_dict)
 
-    get_results(main_workflow_output_dir / 'result' / 'result.zip', main_workflow_output_dir / 'result')
+        start_program(main_workflow_output_dir, pq_cmd=PQ_CMD)
+
+        if not get_results(main_workflow_output_dir / 'result' / 'result.zip', main_workflow_output_dir / 'result',
+                           extract_jobs):
+            sys.exit(1)
 
     logging.info('PrepareDataset has completed successfully')
 
@@ -222,5 +360,27 @@ if __name__ == "__main__":
     required.add_argument('-o', '--output', type=str, required=True,
                           help='Path to the output directory')
 
+    parser.add_argument('-s', '--preselection', choices=PRESELECTION_MODES, default="names",
+                        help='How the candidate ligands for PatternQuery are selected. "names" looks for the ring '
+                             'in the names of the components, "structure" looks for rings of carbons with the '
+                             'right bond orders in their bonds, default: names')
+
+    parser.add_argument('-n', '--shards', type=int, default=1,
+                        help='Number of shards the input is split to, PatternQuery runs for every shard separately. '
+                             'A failed sharded run is resumed by running it again with the same arguments and input, '
+                             'only the shards which were not completed are run (default: 1)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of shards processed by PatternQuery at once (default: 1)')
+    parser.add_argument('-x', '--extract-jobs', type=int, default=1,
+                        help='Number of threads extracting the input archives and the results of PatternQuery. '
+                             'Members extracted by an interrupted run are not extracted again (default: 1)')
+
     args = parser.parse_args()
-    main(args.input, args.output)
+    if args.shards < 1:
+        parser.error('number of shards cannot be lower than one')
+    if args.jobs < 1:
+        parser.error('number of jobs cannot be lower than one')
+    if args.extract_jobs < 1:
+        parser.error('number of extract jobs cannot be lower than one')
+
+    main(args.input, args.output, args.preselection, args.shards, args.jobs, args.extract_jobs)
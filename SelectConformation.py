@@ -1,207 +1,614 @@
-from Bio import PDB
 import numpy as np
 from glob import glob
-from scipy.optimize import shgo
-from numba import jit
-from sys import argv
+from scipy.spatial import cKDTree
+from argparse import ArgumentParser
 import math
 from pathlib import Path
+from multiprocessing import Pool
+import hashlib
+import csv
+import os
+import sqlite3
+from contextlib import nullcontext
+from functools import lru_cache
+from HelperModule.ring_archive import RingArchive, is_ring_archive, read_pattern_atoms
+
+PLANE_SOLVERS = ("svd", "shgo")
+# number of rings sent to a worker process at once, rings of a chunk are analysed together
+CHUNK_SIZE = 512
+TEMPLATES_DIR = Path(__file__).resolve().parent / "QM_optimised_templates"
+# increase when the content of the compiled template cache changes
+TEMPLATE_CACHE_VERSION = 1
+# number of results written to the results store between commits
+STORE_COMMIT_SIZE = 1000
 
 
-def cross(a,b):
-    return np.array([a[1]*b[2]-a[2]*b[1],a[2]*b[0]-a[0]*b[2],a[0]*b[1]-a[1]*b[0]],'g')
-
-def norm(a):
-    return math.sqrt(np.sum(a*a))
-
 def tofloat(a):
     b=[]
     for i in a:
         b.append(float(i))
     return b
 
-@jit(nopython=True, cache=True, fastmath=True)
-def distance_from_plane(point, plane_point, normal_vektor):
-    distance = np.dot(point - plane_point, normal_vektor) / np.linalg.norm(normal_vektor)
-    return distance
-
-@jit(nopython=True, cache=True, fastmath=True)
 def distances_from_plane(coordinates, plane_point, normal_vector):
     return np.sum(np.array([(np.dot(coordinate - plane_point, normal_vector) / np.linalg.norm(normal_vector)) ** 2 for coordinate in coordinates]))
 
+@lru_cache(maxsize=None)
+def jit_compiled(function):
+    # numba is imported and the function is compiled (or loaded from the numba on-disk cache) on the first use,
+    # neither importing this module nor the default SVD plane solver pays for the JIT
+    from numba import jit
+
+    return jit(nopython=True, cache=True, fastmath=True)(function)
+
+def precompile():
+    # ahead-of-time compilation of the numba functions into the on-disk cache, e.g. when building an image
+    jit_compiled(distances_from_plane)(np.zeros((3, 3)), np.zeros(3), np.ones(3))
+
 def obj_fun(normal_vector, plane_point, coordinates):
     try:
-        return distances_from_plane(coordinates, plane_point, normal_vector)# + distances_from_plane([(coordinates[x] + coordinates[(x+1)%len(coordinates)])/2 for x in range(len(coordinates))], plane_point, normal_vector)
+        return jit_compiled(distances_from_plane)(coordinates, plane_point, normal_vector)# + distances_from_plane([(coordinates[x] + coordinates[(x+1)%len(coordinates)])/2 for x in range(len(coordinates))], plane_point, normal_vector)
     except ZeroDivisionError:
         return 1000
 
-class Cycle:
+def fit_plane(coordinates, plane_point, plane_solver="svd"):
+    # normal vector of the plane through plane_point minimising the sum of squared distances,
+    # coordinates can be a single ring (k, 3) or a stack of rings (N, k, 3)
+    if plane_solver == "shgo":
+        if coordinates.ndim == 3:
+            return np.array([fit_plane(c, p, plane_solver) for c, p in zip(coordinates, plane_point)])
+        from scipy.optimize import shgo
+
+        return shgo(obj_fun,
+                    bounds=[[-1, 1] for _ in range(3)],
+                    args=(plane_point, coordinates)).x
+    # closed form: the right singular vector of the centred coordinates
+    # belonging to the smallest singular value
+    _, _, vh = np.linalg.svd(coordinates - plane_point[..., np.newaxis, :])
+    return vh[..., -1, :]
+
+
+class CycleBatch:
+    # Vectorised counterpart of Cycle for N rings of the same size k stored as (N, k, 3) array.
+    # Atoms of every ring have to be already ordered along the ring.
     def __init__(self,
-                 file):
-
-        atoms = [atom for atom in PDB.PDBParser(QUIET=True).get_structure("structure", file)[0].get_atoms() if atom.element != "H"]
-
-        # Atoms of cycles can be stored in file without right ordering.
-        kdtree = PDB.NeighborSearch(atoms)
-        sorted_atoms = [atoms[0],
-                        kdtree.search(center=atoms[0].coord,
-                                      radius=1.8,
-                                      level="A")[1]]
-        for x in range(1, len(atoms) - 1):
-            nearest_atoms = kdtree.search(center=sorted_atoms[x].coord,
-                                          radius=1.8,
-                                          level="A")
-            non_sorted_nearest_atoms = [atom for atom in nearest_atoms if atom not in sorted_atoms]
-            if len(non_sorted_nearest_atoms) != 1:
-                exit("FATAL ERROR 1")
-            sorted_atoms.append(non_sorted_nearest_atoms[0])
+                 coordinates,
+                 plane_solver="svd"):
+
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        number_of_cycles, ring_size = coordinates.shape[:2]
+        rows = np.arange(number_of_cycles)[:, np.newaxis]
 
         # find best plane
-        coordinates = np.array([atom.coord for atom in sorted_atoms], dtype=np.float64)
-        cycle_coordinates_mean = np.array([np.mean([c[0] for c in coordinates]),
-                                           np.mean([c[1] for c in coordinates]),
-                                           np.mean([c[2] for c in coordinates])],
-                                          dtype=np.float64)
-        optimisation = shgo(obj_fun,
-                            bounds=[[-1, 1] for _ in range(3)],
-                            args=(cycle_coordinates_mean, coordinates))
-        distances = [distance_from_plane(c, cycle_coordinates_mean, optimisation.x) for c in coordinates]
-
-        max_central_atom_value = 0
-        central_atom_index = None
-        for x, distance in enumerate(distances):
-            if distance > 0 and distance > distances[(x + 1) % len(distances)] and distance > distances[
-                (x - 1) % len(distances)] or distance < 0 and distance < distances[
-                (x + 1) % len(distances)] and distance < distances[(x - 1) % len(distances)]:
-                central_atom_value = abs(distances[(x - 1) % len(distances)] - distance) + abs(
-                    distance - distances[(x + 1) % len(distances)])
-            else:
-                continue
-            if central_atom_value > max_central_atom_value:
-                max_central_atom_value = central_atom_value
-                central_atom_index = x
-        for i in range(central_atom_index):
-            distances.append(distances.pop(0))
-            sorted_atoms.append(sorted_atoms.pop(0))
+        cycle_coordinates_mean = coordinates.mean(axis=1)
+        normal_vectors = fit_plane(coordinates, cycle_coordinates_mean, plane_solver)
+        distances = np.einsum("nkj,nj->nk", coordinates - cycle_coordinates_mean[:, np.newaxis, :], normal_vectors) \
+            / np.linalg.norm(normal_vectors, axis=1)[:, np.newaxis]
+
+        # central atom is the most protruding local extreme of the distances
+        previous_distances = np.roll(distances, 1, axis=1)
+        next_distances = np.roll(distances, -1, axis=1)
+        is_extreme = ((distances > 0) & (distances > next_distances) & (distances > previous_distances)) | \
+                     ((distances < 0) & (distances < next_distances) & (distances < previous_distances))
+        central_atom_values = np.where(is_extreme,
+                                       np.abs(previous_distances - distances) + np.abs(distances - next_distances),
+                                       0)
+        central_atom_index = np.argmax(central_atom_values, axis=1)
+        self.valid = central_atom_values[rows[:, 0], central_atom_index] > 0
+
+        # rotate the rings so that the central atom is the first one
+        order = (np.arange(ring_size) + central_atom_index[:, np.newaxis]) % ring_size
+        distances = distances[rows, order]
+        distances = np.where(distances[:, :1] < 0, -distances, distances)
+
+        reverse = distances[:, 1] > distances[:, -1]
+        reversed_order = np.concatenate([order[:, :1], order[:, :0:-1]], axis=1)
+        order = np.where(reverse[:, np.newaxis], reversed_order, order)
+        reversed_distances = np.concatenate([distances[:, :1], distances[:, :0:-1]], axis=1)
+        distances = np.where(reverse[:, np.newaxis], reversed_distances, distances)
+
+        self.normal_vectors = normal_vectors
+        self.order = order
+        self.distances = distances
+        self.coordinates = coordinates[rows, order]
 
-        if distances[0] < 0:
-            distances = [x * -1 for x in distances]
+        # calculate Hill-Reilly angles of puckering
+        flappucker = np.concatenate([self.coordinates[:, 1:], self.coordinates[:, :3]], axis=1)
+        r = flappucker[:, 1:ring_size + 1] - flappucker[:, :ring_size]
+        a = flappucker[:, 2:7:2] - flappucker[:, 0:5:2]
+        p = np.cross(r[:, :-1], r[:, 1:])  # p[i] of Cycle is p[i - 1] here
+        q = np.cross(a[:, :ring_size - 3], p[:, 0:2 * (ring_size - 3):2])
+        n = np.cross(a[:, 1], a[:, 0])
+        cosines = np.einsum("nij,nj->ni", q, n) / (np.linalg.norm(q, axis=2) * np.linalg.norm(n, axis=1)[:, np.newaxis])
+        theta = 90 - np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+
+        if ring_size == 5:
+            tr = np.where(theta[:, 0] > theta[:, 1], -1, 1)
+            theta = np.concatenate([theta, np.full((number_of_cycles, 1), np.nan)], axis=1)
+        else:
+            tr = np.where(theta[:, 2] < 0, -1, 1)
+        self.theta = theta * tr[:, np.newaxis]
+
+
+class CycleError(Exception):
+    # ring which cannot be analysed, reported per ring instead of stopping the whole run
+    pass
+
+
+def select_cycle_atoms(atoms):
+    # Element symbols and coordinates of heavy atoms of a pattern (see read_pattern_atoms).
+    # Mirrors what PDBParser gives for the first model: of alternate locations, the one
+    # with the highest occupancy is kept.
+    selected = {}
+    for atom_name, residue, element, occupancy, coordinates in zip(atoms["atom_names"], atoms["residues"], atoms["elements"],
+                                                                  atoms["occupancies"], atoms["coordinates"]):
+        if element == "H":
+            continue
+        key = (atom_name, residue)
+        if key not in selected or occupancy > selected[key][2]:
+            selected[key] = (str(element), coordinates, occupancy)
+    return [atom[0] for atom in selected.values()], np.array([atom[1] for atom in selected.values()], dtype=np.float64).reshape(-1, 3)
+
+
+def read_cycle_pdb(file):
+    # the fixed PDB columns are read directly
+    return select_cycle_atoms(read_pattern_atoms(file))
+
+
+def read_cycle_pdb_biopython(file):
+    # validation counterpart of read_cycle_pdb, Bio.PDB is not needed on the hot path
+    from Bio import PDB
+
+    atoms = [atom for atom in PDB.PDBParser(QUIET=True).get_structure("structure", file)[0].get_atoms() if atom.element != "H"]
+    return [atom.element for atom in atoms], np.array([atom.coord for atom in atoms], dtype=np.float64)
+
+
+def order_cycle_atoms(coordinates):
+    # Atoms of cycles can be stored in file without right ordering.
+    # Atoms closer than 1.8 A are bonded, every atom of a ring has two bonded neighbours,
+    # only the closing bond may be longer than the cut-off.
+    bonds = np.linalg.norm(coordinates[:, np.newaxis] - coordinates[np.newaxis], axis=2) <= 1.8
+    np.fill_diagonal(bonds, False)
+    neighbours = [np.flatnonzero(atom_bonds) for atom_bonds in bonds]
+    ends = [atom for atom, atom_neighbours in enumerate(neighbours) if len(atom_neighbours) == 1]
+    if any(len(atom_neighbours) not in (1, 2) for atom_neighbours in neighbours) or len(ends) not in (0, 2):
+        raise CycleError(f"Ambiguous ring, numbers of bonded neighbours of atoms are {[len(atom_neighbours) for atom_neighbours in neighbours]}.")
+
+    order = [ends[0] if ends else 0]
+    while len(order) < len(coordinates):
+        next_atoms = [atom for atom in neighbours[order[-1]] if atom not in order[-2:]]
+        if not next_atoms or next_atoms[0] == order[0]:
+            raise CycleError(f"Atoms do not form a single ring, only {len(order)} atoms are connected.")
+        order.append(int(next_atoms[0]))
+    return order
+
+
+def read_cycle(file, pdb_reader="fixed", atoms=None):
+    # element symbols and coordinates of the ring atoms ordered along the ring,
+    # atoms of rings from a ring archive are already read
+    elements, coordinates = PDB_READERS[pdb_reader](file) if atoms is None else select_cycle_atoms(atoms)
+    sorted_atoms = order_cycle_atoms(coordinates)
+    return [elements[i] for i in sorted_atoms], coordinates[sorted_atoms]
 
-        if distances[1] > distances[-1]:
-            distances = [distances[0]] + distances[1:][::-1]
-            sorted_atoms = [sorted_atoms[0]] + sorted_atoms[1:][::-1]
 
-        self.distances = distances
+class Cycle:
+    def __init__(self,
+                 file,
+                 plane_solver="svd",
+                 pdb_reader="fixed",
+                 atoms=None):
+
+        elements, coordinates = read_cycle(file, pdb_reader, atoms)
+        batch = CycleBatch(coordinates[np.newaxis], plane_solver)
+        if not batch.valid[0]:
+            raise CycleError("Central atom of the cycle could not be determined.")
+
+        self.distances = [float(distance) for distance in batch.distances[0]]
         self.file = file
-        self.atoms = sorted_atoms
+        self.elements = [elements[i] for i in batch.order[0]]
+        self.coordinates = batch.coordinates[0]
+        self.theta1, self.theta2, self.theta3 = [None if math.isnan(theta) else float(theta) for theta in batch.theta[0]]
 
-        # calculate Hill-Reilly angles of puckering
-        coordinates_flappucker = np.array([atom.coord for atom in self.atoms[1:] + self.atoms[:3]])
-        r=np.zeros((len(self.atoms),3),dtype='float64')
-        a=np.zeros((3,3),dtype='float64')
-        p=np.zeros((len(self.atoms),3),dtype='float64')
-        q=np.zeros((len(self.atoms)-3,3),dtype='float64')
-        center = np.add.reduce(coordinates_flappucker[0:len(self.atoms)])/len(self.atoms)
-        coordinates_flappucker = coordinates_flappucker - center
-        for i in range(0,len(self.atoms)):
-            r[i]=coordinates_flappucker[i+1] - coordinates_flappucker[i]
-        for i in range(0,3):
-            a[i] = coordinates_flappucker[2*(i+1)] - coordinates_flappucker[2*i]
-        for i in range(1,len(self.atoms)):
-            p[i]=cross(r[i-1],r[i])
-        for i in range(0,len(self.atoms)-3):
-            q[i] = cross(a[i],p[2*i+1])
-        n=cross(a[1],a[0])
-        theta=[]
-        for i in q:
-            theta.append(90 - math.degrees(math.acos(np.dot(i,n) / (norm(i)*norm(n)))))
-        if len(theta) == 2:
-            tr = 1
-            if theta[0] > theta[1]:
-                tr = -1
-            self.theta1 = theta[0] * tr
-            self.theta2 = theta[1] * tr
-            self.theta3 = None
-        if len(theta) == 3:
-            tr = 1
-            if theta[2] < 0:
-                tr = -1
-            self.theta1 = theta[0] * tr
-            self.theta2 = theta[1] * tr
-            self.theta3 = theta[2] * tr
-
-
-def superimpose(superimposer, ref_atoms, atoms):
-    superimposer.set_atoms(ref_atoms, atoms)
-    rmsd1 = superimposer.rms
-    superimposer.apply(atoms)
-
-    for atom in atoms:
-        atom.set_coord(atom.get_coord() * -1)
-    superimposer.set_atoms(ref_atoms, atoms)
-    rmsd2 = superimposer.rms
-    if rmsd2 < rmsd1:
-        superimposer.apply(atoms)
-        rmsd = rmsd2
-    else:
-        for atom in atoms:
-            atom.set_coord(atom.get_coord() * -1)
-        rmsd = rmsd1
-    return rmsd
 
+PDB_READERS = {"fixed": read_cycle_pdb,
+               "biopython": read_cycle_pdb_biopython}
+
+
+def superimpose(ref_coordinates, coordinates):
+    # Kabsch superposition of one ring (k, 3) onto every template (T, k, 3) at once,
+    # templates have to be centred (see compile_templates),
+    # returns RMSDs of the ring and of its mirror image against each template
+    moving_coordinates = np.stack([coordinates, -coordinates])
+    moving_coordinates = moving_coordinates - moving_coordinates.mean(axis=1, keepdims=True)
+
+    covariance = np.einsum("mki,tkj->tmij", moving_coordinates, ref_coordinates)
+    u, _, vh = np.linalg.svd(covariance)
+    # correct improper rotations
+    u[..., :, -1] *= np.where(np.linalg.det(u @ vh) < 0, -1, 1)[..., np.newaxis]
+    rotation = u @ vh
 
+    differences = np.einsum("mki,tmij->tmkj", moving_coordinates, rotation) - ref_coordinates[:, np.newaxis]
+    rmsds = np.sqrt(np.mean(np.sum(differences ** 2, axis=3), axis=2))
+    return rmsds[:, 0], rmsds[:, 1]
 
-def load_cycles(type_of_cycle):
+
+def load_cycles(type_of_cycle, plane_solver="svd", pdb_reader="fixed"):
 
     cycles = []
     for cycle_file in glob(f"data/{type_of_cycle}/filtered_ligands/*/*/*.pdb"):
-        cycles.append(Cycle(cycle_file))
+        cycles.append(Cycle(cycle_file, plane_solver, pdb_reader))
     return cycles
 
 
-def load_templates(files):
-    templates = {}
-    for template_file in files:
-        templates[template_file.split("/")[-1][:-4]] = Cycle(template_file)
-    return templates
+def hash_file(file):
+    with open(file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
-type_of_cycle = argv[1]
-print(f"Selection of conformation for {type_of_cycle} cycles. ")
-filtered_ligands_path = argv[2]
-output_dir = argv[3]
+def compile_templates(template_files, plane_solver="svd", pdb_reader="fixed"):
+    templates = [Cycle(template_file, plane_solver, pdb_reader) for template_file in template_files]
+    coordinates = np.array([template.coordinates for template in templates])
+    return {"version": np.array(TEMPLATE_CACHE_VERSION),
+            "conformations": np.array([Path(template_file).stem for template_file in template_files]),
+            "file_hashes": np.array([hash_file(template_file) for template_file in template_files]),
+            "coordinates": coordinates,
+            "centred_coordinates": coordinates - coordinates.mean(axis=1, keepdims=True),
+            "theta": np.array([[template.theta1, template.theta2, np.nan if template.theta3 is None else template.theta3]
+                               for template in templates])}
 
-sup = PDB.Superimposer()
-excluded_rings = []
-QM_templates = load_templates(glob(f"QM_optimised_templates/{type_of_cycle}/*.pdb"))
 
-with open(f"{output_dir}/result_rmsd_chart.csv", "w") as output_file:
+def load_templates(template_dir, plane_solver="svd", pdb_reader="fixed"):
+    # Templates are compiled once into a cache next to the template files.
+    # The cache is rebuilt whenever a template file is added, removed or changed.
+    template_files = sorted(glob(f"{template_dir}/*.pdb"))
+    file_hashes = [hash_file(template_file) for template_file in template_files]
+    cache_file = Path(template_dir) / f"template_cache_{plane_solver}_{pdb_reader}.npz"
+
+    templates = None
+    try:
+        with np.load(cache_file) as cache:
+            if int(cache["version"]) == TEMPLATE_CACHE_VERSION and cache["file_hashes"].tolist() == file_hashes \
+                    and cache["conformations"].tolist() == [Path(template_file).stem for template_file in template_files]:
+                templates = {key: cache[key] for key in cache.files}
+    except Exception:
+        # missing or unreadable cache is rebuilt
+        pass
+
+    if templates is None:
+        templates = compile_templates(template_files, plane_solver, pdb_reader)
+        try:
+            # write to a temporary file first, the cache can be read by other processes at the same time
+            temporary_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+            with open(temporary_file, "wb") as f:
+                np.savez(f, **templates)
+            os.replace(temporary_file, cache_file)
+        except OSError as e:
+            print(f"Template cache {cache_file} could not be written: {e}")
+
+    for array in templates.values():
+        array.flags.writeable = False
+    return templates
 
-    output_file.write("Ligand_name;Ring_ID;" + ";".join([conformation.upper() for conformation in sorted(QM_templates.keys())]) + ";Conformation;Theta1;Theta2;Theta3" + "\n")
 
-    for cycle_file in glob(f"{filtered_ligands_path}/*/*/*.pdb"):
+class ConformationClassifier:
+    # Nearest conformation in the space of Hill-Reilly angles (k - 3 angles for a ring of k atoms),
+    # labelled points are template angles and optionally angles of a reference population of rings.
+    def __init__(self,
+                 theta,
+                 conformations):
+
+        self.conformations = np.asarray(conformations)
+        self.tree = cKDTree(np.asarray(theta, dtype=np.float64))
+
+    @classmethod
+    def from_templates(cls, templates, reference_population_file=None):
+        number_of_angles = templates["coordinates"].shape[1] - 3
+        theta = templates["theta"][:, :number_of_angles]
+        conformations = templates["conformations"]
+        if reference_population_file is not None:
+            reference_theta, reference_conformations = load_reference_population(reference_population_file, number_of_angles)
+            theta = np.concatenate([theta, reference_theta])
+            conformations = np.concatenate([conformations, reference_conformations])
+        return cls(theta, conformations)
+
+    def classify(self, theta, k=1):
+        # theta (N, number of angles), returns conformations and distances of k nearest labelled points,
+        # shaped (N,) for k == 1 and (N, k) otherwise
+        distances, indices = self.tree.query(np.asarray(theta, dtype=np.float64)[:, :self.tree.m], k=k)
+        return self.conformations[indices], distances
+
+
+def load_reference_population(file, number_of_angles):
+    # reference rings with known conformation in the format of result_rmsd_chart.csv
+    with open(file) as reference_file:
+        rows = list(csv.DictReader(reference_file, delimiter=";"))
+    theta = np.array([[float(row[f"Theta{i + 1}"]) for i in range(number_of_angles)] for row in rows], dtype=np.float64)
+    return theta.reshape(len(rows), number_of_angles), np.array([row["Conformation"].lower() for row in rows])
+
+
+def get_cycle_batches(coordinates, plane_solver="svd"):
+    # rings (list of (k, 3) arrays) are stacked by their size and analysed by one CycleBatch per stack,
+    # returns the batch and the row of every ring, or the error if the ring cannot be analysed
+    results = [None] * len(coordinates)
+    stacks = {}
+    for i, cycle_coordinates in enumerate(coordinates):
+        stacks.setdefault(len(cycle_coordinates), []).append(i)
+    for indices in stacks.values():
+        try:
+            batches = [(CycleBatch(np.stack([coordinates[i] for i in indices]), plane_solver), indices)]
+        except Exception:
+            # the failing stack is analysed ring by ring to report the error of each ring
+            batches = []
+            for i in indices:
+                try:
+                    batches.append((CycleBatch(coordinates[i][np.newaxis], plane_solver), [i]))
+                except Exception as e:
+                    results[i] = e
+        for batch, batch_indices in batches:
+            for row, i in enumerate(batch_indices):
+                results[i] = (batch, row) if batch.valid[row] else CycleError("Central atom of the cycle could not be determined.")
+    return results
+
+
+def to_error_record(cycle_file, error):
+    if isinstance(error, CycleError):
+        return {"file": cycle_file, "error": str(error)}
+    return {"file": cycle_file, "error": f"{type(error).__name__}: {error}"}
+
+
+def select_conformations(cycle_files, templates, classifier, plane_solver="svd", pdb_reader="fixed", atoms=None):
+    # records of rings in the order of cycle_files, the error is set when the ring was excluded
+    records = [None] * len(cycle_files)
+    read_files, read_coordinates = [], []
+    for i, cycle_file in enumerate(cycle_files):
         try:
-            cycle = Cycle(cycle_file)
-            item1 = Path(cycle.file).name.split("_")[0]
-            item2 = Path(cycle.file).name.split(".")[0]
-            print(f"Selection of conformation for {item1}, {item2}")
-            cycle.rmsds = {}
-            best_achieved_hr_distance = 1000 # hill-reilly
-            for conformation in QM_templates.keys():
-                QM_template = QM_templates[conformation]
-                if type_of_cycle in ["cyclohexane", "benzene"]:
-                    hr_distance = math.dist((QM_template.theta1, QM_template.theta2, QM_template.theta3), (cycle.theta1, cycle.theta2, cycle.theta3))
-                elif type_of_cycle == "cyclopentane":
-                    hr_distance = math.dist((QM_template.theta1, QM_template.theta2), (cycle.theta1, cycle.theta2))
-                if hr_distance < best_achieved_hr_distance:
-                    best_achieved_hr_distance = hr_distance
-                    cycle.conformation = conformation
-                cycle.rmsds[conformation] = superimpose(sup, QM_template.atoms, cycle.atoms)
-            output_file.write(f"{item1};{item2};{';'.join([str(round(float(cycle.rmsds[conformation]), 3)) for conformation in sorted(QM_templates.keys())])};{cycle.conformation.upper()};{cycle.theta1};{cycle.theta2};{cycle.theta3}\n")
-        except:
-            excluded_rings.append(cycle_file)
-
-
-print(f"Selection of conformation for {type_of_cycle} cycles has completed successfully. {len(excluded_rings)} cycles excluded.")
-for excluded_ring in excluded_rings:
-    print(f"EXCLUDED: {excluded_ring}")
\ No newline at end of file
+            _, coordinates = read_cycle(cycle_file, pdb_reader, None if atoms is None else atoms[i])
+            read_files.append(i)
+            read_coordinates.append(coordinates)
+        except Exception as e:
+            records[i] = to_error_record(cycle_file, e)
+
+    superimposed = []
+    for i, result in zip(read_files, get_cycle_batches(read_coordinates, plane_solver)):
+        if isinstance(result, Exception):
+            records[i] = to_error_record(cycle_files[i], result)
+            continue
+        batch, row = result
+        try:
+            rmsds, mirror_rmsds = superimpose(templates["centred_coordinates"], batch.coordinates[row])
+        except Exception as e:
+            records[i] = to_error_record(cycle_files[i], e)
+            continue
+        superimposed.append((i, batch.theta[row], np.minimum(rmsds, mirror_rmsds)))
+    if not superimposed:
+        return records
+
+    # nearest conformations of all rings are found by one query
+    theta = np.array([cycle_theta for _, cycle_theta, _ in superimposed])
+    conformations, _ = classifier.classify(theta)
+    for (i, cycle_theta, rmsds), conformation in zip(superimposed, conformations):
+        cycle_file = cycle_files[i]
+        theta1, theta2, theta3 = [None if math.isnan(angle) else float(angle) for angle in cycle_theta]
+        records[i] = {"file": cycle_file,
+                      "ligand_name": Path(cycle_file).name.split("_")[0],
+                      "ring_id": Path(cycle_file).name.split(".")[0],
+                      "rmsds": {str(template_conformation): float(rmsd) for template_conformation, rmsd
+                                in zip(templates["conformations"], rmsds)},
+                      "conformation": str(conformation),
+                      "theta1": theta1,
+                      "theta2": theta2,
+                      "theta3": theta3,
+                      "error": None}
+    return records
+
+
+def format_row(record):
+    # row of result_rmsd_chart.csv
+    return f"{record['ligand_name']};{record['ring_id']};{';'.join([str(round(rmsd, 3)) for rmsd in record['rmsds'].values()])};{record['conformation'].upper()};{record['theta1']};{record['theta2']};{record['theta3']}\n"
+
+
+class ResultsStore:
+    # Persistent results of SelectConformation runs keyed by the ring file path.
+    # A stored result is reused only if both the content of the ring file and the settings
+    # (templates, plane solver, PDB reader, reference population) are unchanged.
+    def __init__(self,
+                 file,
+                 settings_hash):
+
+        self.settings_hash = settings_hash
+        self.connection = sqlite3.connect(file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (path TEXT PRIMARY KEY, content_hash TEXT, "
+                                "settings_hash TEXT, row TEXT, error TEXT)")
+
+    def pending(self, cycle_files, content_hashes):
+        # ring files without a valid stored result
+        stored = dict(((path, (content_hash, settings_hash)) for path, content_hash, settings_hash
+                       in self.connection.execute("SELECT path, content_hash, settings_hash FROM results")))
+        return [(cycle_file, content_hash) for cycle_file, content_hash in zip(cycle_files, content_hashes)
+                if stored.get(cycle_file) != (content_hash, self.settings_hash)]
+
+    def update(self, results):
+        # results are (cycle_file, content_hash, row, error), committed in chunks to keep the progress of interrupted runs
+        for i, (cycle_file, content_hash, row, error) in enumerate(results, start=1):
+            self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                                    (cycle_file, content_hash, self.settings_hash, row, error))
+            if i % STORE_COMMIT_SIZE == 0:
+                self.connection.commit()
+        self.connection.commit()
+
+    def results(self, cycle_files):
+        # stored results of cycle_files in their order, results of other files are removed from the store
+        stored = {path: (row, error) for path, row, error in self.connection.execute("SELECT path, row, error FROM results")}
+        removed = stored.keys() - set(cycle_files)
+        self.connection.executemany("DELETE FROM results WHERE path = ?", [(path,) for path in removed])
+        self.connection.commit()
+        return [(cycle_file, *stored[cycle_file]) for cycle_file in cycle_files]
+
+    def close(self):
+        self.connection.close()
+
+
+def get_settings_hash(templates, plane_solver, pdb_reader, reference_population_file=None):
+    settings = [str(TEMPLATE_CACHE_VERSION), plane_solver, pdb_reader] + templates["conformations"].tolist() \
+        + templates["file_hashes"].tolist()
+    if reference_population_file is not None:
+        settings.append(hash_file(reference_population_file))
+    return hashlib.sha256(";".join(settings).encode()).hexdigest()
+
+
+# state of a worker process, templates are loaded only once per worker
+worker_state = {}
+
+
+def init_worker(type_of_cycle, plane_solver, pdb_reader, reference_population_file=None, ring_archive=None):
+    worker_state["initargs"] = (type_of_cycle, plane_solver, pdb_reader, reference_population_file, ring_archive)
+    worker_state["plane_solver"] = plane_solver
+    worker_state["pdb_reader"] = pdb_reader
+    worker_state["templates"] = load_templates(f"{TEMPLATES_DIR}/{type_of_cycle}", plane_solver, pdb_reader)
+    worker_state["classifier"] = ConformationClassifier.from_templates(worker_state["templates"], reference_population_file)
+    worker_state["archive"] = None if ring_archive is None else RingArchive(ring_archive)
+
+
+def get_archive_name(cycle_file):
+    # rings of an archive are named as their files would be in filtered_ligands next to the archive
+    return Path(cycle_file).relative_to(worker_state["archive"].rings_dir).as_posix()
+
+
+def hash_cycle_file(cycle_file):
+    if worker_state["archive"] is None:
+        return hash_file(cycle_file)
+    return worker_state["archive"].get_content_hash(get_archive_name(cycle_file))
+
+
+def process_cycle_files(cycle_files):
+    # returns the records of the rings, the error is set when the ring was excluded
+    atoms = None if worker_state["archive"] is None \
+        else [worker_state["archive"].get_atoms(get_archive_name(cycle_file)) for cycle_file in cycle_files]
+    return select_conformations(cycle_files,
+                                worker_state["templates"],
+                                worker_state["classifier"],
+                                worker_state["plane_solver"],
+                                worker_state["pdb_reader"],
+                                atoms)
+
+
+def classify_rings(paths, ring_type, plane_solver="svd", pdb_reader="fixed", reference_population_file=None, jobs=1):
+    # Selection of conformation for ring PDB files of one ring type, returns one record per ring in the order
+    # of paths. Templates stay loaded between calls with the same settings.
+    initargs = (ring_type, plane_solver, pdb_reader, reference_population_file, None)
+    if worker_state.get("initargs") != initargs:
+        init_worker(*initargs)
+    cycle_files = [str(path) for path in paths]
+    if jobs == 1:
+        return process_cycle_files(cycle_files)
+    with Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+        return list(map_chunks(pool, process_cycle_files, cycle_files))
+
+
+def to_result(record):
+    # (cycle_file, row, error) of a record for the output files
+    if record["error"] is not None:
+        return record["file"], None, record["error"]
+    print(f"Selection of conformation for {record['ligand_name']}, {record['ring_id']}")
+    return record["file"], format_row(record), None
+
+
+def map_ordered(pool, function, items):
+    if pool is None:
+        return map(function, items)
+    return pool.imap(function, items, chunksize=CHUNK_SIZE)
+
+
+def map_chunks(pool, function, items):
+    # function processes a list of items at once, results are flattened in the order of items
+    chunks = [items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+    results = map(function, chunks) if pool is None else pool.imap(function, chunks)
+    return (result for chunk_results in results for result in chunk_results)
+
+
+def write_results(output_dir, conformations, results):
+    # results are (cycle_file, row, error) tuples, returns the excluded rings
+    excluded_rings = []
+    with open(f"{output_dir}/result_rmsd_chart.csv", "w") as output_file:
+        output_file.write("Ligand_name;Ring_ID;" + ";".join([conformation.upper() for conformation in conformations]) + ";Conformation;Theta1;Theta2;Theta3" + "\n")
+        for cycle_file, row, error in results:
+            if row is None:
+                excluded_rings.append((cycle_file, error))
+            else:
+                output_file.write(row)
+
+    with open(f"{output_dir}/excluded_rings.csv", "w") as excluded_file:
+        excluded_file.write("File;Reason\n")
+        for excluded_ring, error in excluded_rings:
+            excluded_file.write(f"{excluded_ring};{error}\n")
+    return excluded_rings
+
+
+def main():
+    parser = ArgumentParser(description="Select the conformation of filtered rings by comparison with QM optimised templates")
+    parser.add_argument("type_of_cycle", type=str,
+                        help="Ring type (cyclohexane, cyclopentane or benzene)")
+    parser.add_argument("filtered_ligands_path", type=str,
+                        help="Path to the directory with filtered ligands from FilterDataset, "
+                             "or to the ring archive (filtered_ligands_archive) written by FilterDataset instead")
+    parser.add_argument("output_dir", type=str,
+                        help="Path to the output directory for result_rmsd_chart.csv")
+    parser.add_argument("--plane-solver", type=str, choices=PLANE_SOLVERS, default="svd",
+                        help="Method used to find the mean plane of a ring. 'svd' is the closed-form least-squares fit, "
+                             "'shgo' is the original global optimisation (kept for regression comparison)")
+    parser.add_argument("--pdb-reader", type=str, choices=PDB_READERS.keys(), default="fixed",
+                        help="Reader of ring PDB files. 'fixed' reads the fixed PDB columns directly, "
+                             "'biopython' uses Bio.PDB.PDBParser (kept for validation)")
+    parser.add_argument("--reference-population", type=str, default=None,
+                        help="CSV file in the format of result_rmsd_chart.csv with rings of known conformation, "
+                             "their Hill-Reilly angles are used for the assignment of conformation together with "
+                             "the templates")
+    parser.add_argument("--results-store", type=str, default=None,
+                        help="SQLite file with results of previous runs. Only new or changed rings are processed "
+                             "and result_rmsd_chart.csv is regenerated from the store")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes used for the selection of conformation (default: 1)")
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("number of jobs cannot be lower than one")
+
+    type_of_cycle = args.type_of_cycle
+    print(f"Selection of conformation for {type_of_cycle} cycles. ")
+    filtered_ligands_path = args.filtered_ligands_path
+    output_dir = args.output_dir
+
+    ring_archive = filtered_ligands_path if is_ring_archive(filtered_ligands_path) else None
+    initargs = (type_of_cycle, args.plane_solver, args.pdb_reader, args.reference_population, ring_archive)
+    init_worker(*initargs)
+
+    # rings are processed in sorted order and results are written in the same order, regardless of the number of jobs
+    if ring_archive is None:
+        cycle_files = sorted(glob(f"{filtered_ligands_path}/*/*/*.pdb"))
+    else:
+        cycle_files = sorted(f"{worker_state['archive'].rings_dir}/{name}" for name in worker_state["archive"].names)
+    QM_templates = worker_state["templates"]
+
+    with Pool(args.jobs, initializer=init_worker, initargs=initargs) if args.jobs > 1 else nullcontext() as pool:
+        if args.results_store is None:
+            excluded_rings = write_results(output_dir, QM_templates["conformations"],
+                                           map(to_result, map_chunks(pool, process_cycle_files, cycle_files)))
+        else:
+            store = ResultsStore(args.results_store, get_settings_hash(QM_templates, args.plane_solver, args.pdb_reader,
+                                                                       args.reference_population))
+            try:
+                pending = store.pending(cycle_files, map_ordered(pool, hash_cycle_file, cycle_files))
+                print(f"{len(pending)} of {len(cycle_files)} {type_of_cycle} cycles are new or changed.")
+                content_hashes = dict(pending)
+                store.update((cycle_file, content_hashes[cycle_file], row, error) for cycle_file, row, error
+                             in map(to_result, map_chunks(pool, process_cycle_files, [cycle_file for cycle_file, _ in pending])))
+                excluded_rings = write_results(output_dir, QM_templates["conformations"], store.results(cycle_files))
+            finally:
+                store.close()
+
+    print(f"Selection of conformation for {type_of_cycle} cycles has completed successfully. {len(excluded_rings)} cycles excluded.")
+    for excluded_ring, error in excluded_rings:
+        print(f"EXCLUDED: {excluded_ring} ({error})")
+
+
+if __name__ == "__main__":
+    main()
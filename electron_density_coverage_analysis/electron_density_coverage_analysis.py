@@ -1,74 +1,260 @@
 import argparse
 import logging
+import os
+from pathlib import Path
 import gemmi
 import statistics as st
-import math
+import numpy as np
+
+# number of voxels of the map reduced at once when the sigma is computed
+SIGMA_CHUNK_SIZE = 1 << 22
+# increase when the content of the cached boxes changes
+BOX_CACHE_VERSION = 2
 
 
 def run_as_function(args: argparse.Namespace):
     return run_analysis(args)
 
 
-# compare intensity, corresponding to the given position, to the threshold for isosurface (MORE vs MORE OR EQUAL)
-def determine_atom_coverage(pos, map, sigma_lvl, args: argparse.Namespace):
-    try:
-        if args.more_or_equal:
-            return get_intensity(pos, map, args) >= sigma_lvl
-        return get_intensity(pos, map, args) > sigma_lvl
-    except Exception as e:
-        logging.error(e, stack_info=True, exc_info=True)
+# compare intensities to the threshold for isosurface (MORE vs MORE OR EQUAL), NaN intensities are not covered
+def determine_atoms_coverage(intensities: np.ndarray, sigma_lvl, args: argparse.Namespace) -> np.ndarray:
+    if args.more_or_equal:
+        return intensities >= sigma_lvl
+    return intensities > sigma_lvl
 
 
-# get intensity corresponding to the given position (trilinear interpolation vs itensity of the closest voxel)
-def get_intensity(pos, map, args: argparse.Namespace):
-    try:
-        if args.closest_voxel:
-            return map.grid.get_nearest_point(pos).value
-        return map.grid.interpolate_value(pos)
-    except Exception as e:
-        logging.error(e, stack_info=True, exc_info=True)
+# get intensities corresponding to the (N, 3) positions (trilinear interpolation vs itensity of the closest voxel)
+def get_intensities(positions: np.ndarray, map, args: argparse.Namespace) -> np.ndarray:
+    if isinstance(map, DensityBox):
+        return map.get_nearest_values(positions) if args.closest_voxel else map.interpolate_values(positions)
+    grid = map.grid
+    if args.closest_voxel:
+        shape = (grid.nu, grid.nv, grid.nw)
+        return get_nearest_values(np.asarray(grid), (0, 0, 0), to_grid_points(grid.unit_cell, shape, positions))
+    if hasattr(grid, 'interpolate_position_array'):
+        return grid.interpolate_position_array(np.ascontiguousarray(positions, dtype=np.float64)).astype(np.float64)
+    # older gemmi has no batch interpolation
+    return np.array([grid.interpolate_value(gemmi.Position(*pos)) for pos in positions], dtype=np.float64)
+
+
+def to_grid_points(cell: gemmi.UnitCell, shape, positions: np.ndarray) -> np.ndarray:
+    # (N, 3) positions in the coordinates of the grid of the unit cell, the fractional coordinates are computed
+    # in the same order of operations as gemmi.UnitCell.fractionalize
+    matrix = np.array(cell.frac.mat.tolist())
+    vector = np.array(cell.frac.vec.tolist())
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    fractional = (matrix[:, 0] * positions[:, 0:1] + matrix[:, 1] * positions[:, 1:2]) + \
+        matrix[:, 2] * positions[:, 2:3] + vector
+    return fractional * np.array(shape, dtype=np.float64)
+
+
+def get_nearest_values(values: np.ndarray, origin, points: np.ndarray) -> np.ndarray:
+    # values of the grid points nearest to the points, rounded half away from zero as in gemmi. values hold
+    # the grid from the origin on, indices wrap around the grid of the unit cell.
+    nearest = (np.trunc(points + np.copysign(0.5, points)).astype(np.int64) - np.array(origin)) % values.shape
+    return values[nearest[:, 0], nearest[:, 1], nearest[:, 2]].astype(np.float64)
+
+
+# Values of a map in a box of grid points around a ring, the box wraps around the grid of the unit cell.
+# Intensities are computed as gemmi computes them on the whole map.
+class DensityBox:
+    def __init__(self, cell: gemmi.UnitCell, shape, origin, values: np.ndarray):
+        self.cell = cell
+        # shape of the grid of the unit cell and the grid point of the box corner
+        self.shape = tuple(int(n) for n in shape)
+        self.origin = tuple(int(i) for i in origin)
+        self.values = values
+
+    @classmethod
+    def from_map(cls, map, positions: np.ndarray, margin: float):
+        # the box covers the positions, the given margin in angstroms and the neighbours needed for interpolation
+        grid = map.grid
+        shape = (grid.nu, grid.nv, grid.nw)
+        points = to_grid_points(grid.unit_cell, shape, positions)
+        margin_points = margin / np.array([grid.spacing[0], grid.spacing[1], grid.spacing[2]])
+        lo = np.floor(points.min(axis=0) - margin_points).astype(int)
+        hi = np.floor(points.max(axis=0) + margin_points).astype(int) + 2
+        indices = [np.arange(l, h) % n for l, h, n in zip(lo, hi, shape)]
+        return cls(grid.unit_cell, shape, lo, np.asarray(grid)[np.ix_(*indices)].copy())
+
+    def get_nearest_values(self, positions: np.ndarray) -> np.ndarray:
+        return get_nearest_values(self.values, self.origin, to_grid_points(self.cell, self.shape, positions))
+
+    def interpolate_values(self, positions: np.ndarray) -> np.ndarray:
+        # trilinear interpolation, the results are rounded to float32 as the values of the map
+        points = to_grid_points(self.cell, self.shape, positions)
+        corners = np.floor(points)
+        u, v, w = (corners.astype(np.int64) - np.array(self.origin)).T
+        xd, yd, zd = (points - corners).T
+        values = self.values.astype(np.float64)
+        avg = [(1 - yd) * ((1 - xd) * values[u, v, w + i] + xd * values[u + 1, v, w + i]) +
+               yd * ((1 - xd) * values[u, v + 1, w + i] + xd * values[u + 1, v + 1, w + i]) for i in range(2)]
+        return ((1 - zd) * avg[0] + zd * avg[1]).astype(np.float32).astype(np.float64)
+
+
+def get_box_cache_stamp(input_density_ccp4: str, margin: float) -> str:
+    stat = os.stat(input_density_ccp4)
+    return f"{BOX_CACHE_VERSION};{stat.st_size};{stat.st_mtime_ns};{margin}"
+
+
+def read_box_cache(path_to_cache: Path, stamp: str, cycles: dict):
+    # (sigma level, boxes of the rings) of the entry, None if the cache is outdated, some ring is missing
+    # or the positions of its atoms have changed
+    if not path_to_cache.exists():
+        return None
+    with np.load(path_to_cache, allow_pickle=False) as data:
+        if str(data['stamp']) != stamp:
+            return None
+        stored = {str(name): i for i, name in enumerate(data['names'])}
+        if any(name not in stored or not np.array_equal(data[f'positions_{stored[name]}'], positions)
+               for name, (_, positions) in cycles.items()):
+            return None
+        cell = gemmi.UnitCell(*data['cell'])
+        boxes = {str(name): DensityBox(cell, data['shape'], origin, data[f'values_{i}'])
+                 for i, (name, origin) in enumerate(zip(data['names'], data['origins']))}
+        return float(data['sigma_lvl']), boxes
+
+
+def write_box_cache(path_to_cache: Path, stamp: str, map, sigma_lvl: float, boxes: dict, cycles: dict) -> None:
+    os.makedirs(path_to_cache.parent, exist_ok=True)
+    temporary_path = path_to_cache.with_name(f"{path_to_cache.stem}.{os.getpid()}.tmp.npz")
+    cell = map.grid.unit_cell
+    np.savez(temporary_path,
+             stamp=np.array(stamp),
+             sigma_lvl=np.array(sigma_lvl),
+             cell=np.array([cell.a, cell.b, cell.c, cell.alpha, cell.beta, cell.gamma]),
+             shape=np.array([map.grid.nu, map.grid.nv, map.grid.nw]),
+             names=np.array(list(boxes), dtype=str),
+             origins=np.array([box.origin for box in boxes.values()], dtype=np.int64).reshape(-1, 3),
+             **{f'values_{i}': box.values for i, box in enumerate(boxes.values())},
+             **{f'positions_{i}': cycles[name][1] for i, name in enumerate(boxes)})
+    os.replace(temporary_path, path_to_cache)
+
+
+def read_boxes(input_density_ccp4: str, cycles: dict, margin: float, cache_dir: str | None = None):
+    # sigma level of the map and the boxes around the rings {name: (serials, positions)} of one PDB entry.
+    # The whole map is read only when the boxes are not cached, it is released as soon as the boxes are cut out of it.
+    # Rings of different ring types can have the same name, so every ring type needs its own cache_dir.
+    if cache_dir is not None:
+        stamp = get_box_cache_stamp(input_density_ccp4, margin)
+        path_to_cache = Path(cache_dir) / (Path(input_density_ccp4).name.split('.')[0] + '.npz')
+        cached = read_box_cache(path_to_cache, stamp, cycles)
+        if cached is not None:
+            return cached
+
+    map = read_map(input_density_ccp4)
+    sigma_lvl = get_sigma_level(map)
+    boxes = {name: DensityBox.from_map(map, positions, margin) for name, (_, positions) in cycles.items()}
+    if cache_dir is not None:
+        write_box_cache(path_to_cache, stamp, map, sigma_lvl, boxes, cycles)
+    return sigma_lvl, boxes
+
+
+def read_cycle_atoms(input_cycle_pdb: str, cycle_atoms: dict | None = None):
+    # serials and (N, 3) positions of the atoms of the ring
+    if cycle_atoms is not None:
+        return ([int(serial) for serial in cycle_atoms['serials']],
+                np.asarray(cycle_atoms['coordinates'], dtype=np.float64).reshape(-1, 3))
+    str = gemmi.read_pdb(input_cycle_pdb)
+    atoms = [atom for model in str for chain in model for res in chain for atom in res]
+    return [atom.serial for atom in atoms], np.array([[atom.pos.x, atom.pos.y, atom.pos.z] for atom in atoms],
+                                                      dtype=np.float64).reshape(-1, 3)
+
+
+def read_map(input_density_ccp4: str):
+    map = gemmi.read_ccp4_map(input_density_ccp4)
+    map.setup(float('nan'))
+    return map
+
+
+# threshold for the isosurface, 1.5 sigma of the map
+def get_sigma_level(map):
+    # population standard deviation of the values which are not NaN, computed in float64 in two passes
+    # over chunks of the grid, so that no float64 copy of the whole grid is made
+    values = np.asarray(map.grid).reshape(-1)
+    chunks = [values[i:i + SIGMA_CHUNK_SIZE] for i in range(0, len(values), SIGMA_CHUNK_SIZE)]
+
+    count = 0
+    total = 0.0
+    for chunk in chunks:
+        chunk = chunk[~np.isnan(chunk)]
+        count += len(chunk)
+        total += chunk.sum(dtype=np.float64)
+    if count == 0:
+        raise st.StatisticsError('pstdev requires at least one data point')
+    mean = total / count
+
+    squared_deviations = 0.0
+    for chunk in chunks:
+        deviations = chunk[~np.isnan(chunk)].astype(np.float64) - mean
+        squared_deviations += np.dot(deviations, deviations)
+
+    std = float(np.sqrt(squared_deviations / count))
+    return 1.5 * std
+
+
+def analyse_cycle(serials, covered: np.ndarray, args: argparse.Namespace):
+    output = None
+    if args.s:
+        output = f'{int(np.count_nonzero(covered))};{len(serials)}'
+
+    if args.d:
+        output = [f'{serial};{"y" if atom_covered else "n"};' for serial, atom_covered in zip(serials, covered)]
+    return output
 
 
 def run_analysis(args: argparse.Namespace):
     try:
         output = None
-        str = gemmi.read_pdb(args.input_cycle_pdb)
-        map = gemmi.read_ccp4_map(args.input_density_ccp4)
-        map.setup(float('nan'))
-
-        # calculate the sigma values
-        grid_values = []
-        for point in map.grid:
-            if not math.isnan(point.value):
-                grid_values.append(point.value)
-
-        std = st.pstdev(grid_values)
-        sigma_lvl = 1.5 * std
-
-        if args.s:
-            total_atom_count = 0
-            covered_atoms_count = 0
-            for model in str:
-                for chain in model:
-                    for res in chain:
-                        for atom in res:
-                            total_atom_count = total_atom_count + 1
-                            if determine_atom_coverage(atom.pos, map, sigma_lvl, args):
-                                covered_atoms_count = covered_atoms_count + 1
-
-            output = f'{covered_atoms_count};{total_atom_count}'
-
-        if args.d:
-            output = []
-            for model in str:
-                for chain in model:
-                    for res in chain:
-                        for atom in res:
-                            if determine_atom_coverage(atom.pos, map, sigma_lvl, args):
-                                output.append(f'{atom.serial};y;')
-                            else:
-                                output.append(f'{atom.serial};n;')
+        serials, positions = read_cycle_atoms(args.input_cycle_pdb, getattr(args, 'cycle_atoms', None))
+        map = read_map(args.input_density_ccp4)
+        sigma_lvl = get_sigma_level(map)
+        covered = determine_atoms_coverage(get_intensities(positions, map, args), sigma_lvl, args)
+        output = analyse_cycle(serials, covered, args)
     except Exception as e:
         logging.error(e, stack_info=True, exc_info=True)
 
     return output
+
+
+def run_analysis_for_entry(args: argparse.Namespace, cycles: list):
+    # all the rings (input_cycle_pdb, cycle_atoms) of one PDB entry share the map of args.input_density_ccp4,
+    # so it is read and its sigma is computed only once, and the intensities of the atoms of all the rings are
+    # computed in one call. With args.box_margin, the rings are analysed in boxes cut out of the map around them.
+    # Returns the outputs and (serials, intensities, coverage) of the atoms in the order of cycles.
+    outputs = [None] * len(cycles)
+    atom_intensities = [None] * len(cycles)
+    atoms = {}
+    for i, (input_cycle_pdb, cycle_atoms) in enumerate(cycles):
+        try:
+            atoms[i] = read_cycle_atoms(input_cycle_pdb, cycle_atoms)
+        except Exception as e:
+            logging.error(e, stack_info=True, exc_info=True)
+
+    box_margin = getattr(args, 'box_margin', None)
+    try:
+        if box_margin is not None:
+            names = {i: Path(cycles[i][0]).stem for i in atoms}
+            sigma_lvl, boxes = read_boxes(args.input_density_ccp4, {names[i]: atoms[i] for i in atoms}, box_margin,
+                                          getattr(args, 'box_cache_dir', None))
+            intensities = {i: get_intensities(atoms[i][1], boxes[names[i]], args) for i in atoms}
+        else:
+            map = read_map(args.input_density_ccp4)
+            sigma_lvl = get_sigma_level(map)
+            positions = [atoms[i][1] for i in atoms]
+            all_intensities = get_intensities(np.concatenate(positions) if positions else np.empty((0, 3)), map, args)
+            offsets = np.cumsum([len(ring_positions) for ring_positions in positions])[:-1]
+            intensities = dict(zip(atoms, np.split(all_intensities, offsets)))
+    except Exception as e:
+        logging.error(e, stack_info=True, exc_info=True)
+        return outputs, atom_intensities
+
+    for i in atoms:
+        try:
+            covered = determine_atoms_coverage(intensities[i], sigma_lvl, args)
+            outputs[i] = analyse_cycle(atoms[i][0], covered, args)
+            atom_intensities[i] = (atoms[i][0], intensities[i], covered)
+        except Exception as e:
+            logging.error(e, stack_info=True, exc_info=True)
+
+    return outputs, atom_intensities
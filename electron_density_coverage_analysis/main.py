@@ -4,7 +4,15 @@ from multiprocessing import Pool, cpu_count
 import argparse
 from pathlib import Path
 import shutil
-from electron_density_coverage_analysis import run_as_function
+import os
+import sys
+import numpy as np
+from electron_density_coverage_analysis import run_as_function, run_analysis_for_entry
+
+# HelperModule is in the root directory of the repository
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from HelperModule.constants import RING_ARCHIVE
+from HelperModule.ring_archive import RingArchive, is_ring_archive
 
 CPU_COUNT = cpu_count()
 
@@ -32,13 +40,15 @@ def process_args(args: argparse.Namespace):
             a.closest_voxel = True
         if args.more_or_equal:
             a.more_or_equal = True
+        a.box_margin = args.box_margin
+        a.box_cache_dir = args.box_cache_dir
     except Exception as e:
         logging.error(e, stack_info=True, exc_info=True)
 
     return a
 
 
-def run_exe(ligand_filepath: Path, ccp4_dir_path: Path, arguments: argparse.Namespace):
+def run_exe(ligand_filepath: Path, ccp4_dir_path: Path, arguments: argparse.Namespace, cycle_atoms: dict | None = None):
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s',
                         )
@@ -49,6 +59,8 @@ def run_exe(ligand_filepath: Path, ccp4_dir_path: Path, arguments: argparse.Name
         ccp4_filepath = (ccp4_dir_path / (pdb_id + '.ccp4.gz')).resolve()
         arguments.input_cycle_pdb = str(ligand_filepath.resolve())
         arguments.input_density_ccp4 = str(ccp4_filepath)
+        # atoms of rings from the ring archive, the ring is not read from ligand_filepath
+        arguments.cycle_atoms = cycle_atoms
 
         logging.info(f"Analysing file: {arguments.input_cycle_pdb}...")
         output = run_as_function(arguments)
@@ -59,20 +71,55 @@ def run_exe(ligand_filepath: Path, ccp4_dir_path: Path, arguments: argparse.Name
     return result
 
 
-def get_filepaths(rootdir: Path, ccp4_dir: Path, ring_type: str):
+def run_exe_for_entry(pdb_id: str, rings: list, ccp4_dir_path: Path, arguments: argparse.Namespace):
+    # rings are (index, ligand_filepath, cycle_atoms) of one PDB entry, returns (index, row, atom rows) of every ring,
+    # the atom rows hold the intensity and the coverage of every atom of the ring
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        )
+    arguments.input_density_ccp4 = str((ccp4_dir_path / (pdb_id + '.ccp4.gz')).resolve())
+    logging.info(f"Analysing {len(rings)} rings of {pdb_id}...")
+    outputs, atom_intensities = run_analysis_for_entry(arguments, [(str(ligand_filepath.resolve()), cycle_atoms)
+                                                                   for _, ligand_filepath, cycle_atoms in rings])
+
+    results = []
+    for (i, ligand_filepath, _), output, atoms in zip(rings, outputs, atom_intensities):
+        pq_pdb_name, residue_id = ligand_filepath.name.split(".")[0], ligand_filepath.parent.parent.name
+        atom_rows = [] if atoms is None else [(pq_pdb_name, residue_id, serial, float(intensity),
+                                               'y' if covered else 'n') for serial, intensity, covered in zip(*atoms)]
+        results.append((i, (pq_pdb_name, residue_id, output), atom_rows))
+    return results
+
+
+def group_by_pdb_id(filepaths: list):
+    # rings of every PDB entry in the order of filepaths, the index of every ring in filepaths is kept
+    groups = {}
+    for i, (ligand_filepath, cycle_atoms) in enumerate(filepaths):
+        pdb_id = ligand_filepath.name.split(".")[0].split('_')[1]
+        groups.setdefault(pdb_id, []).append((i, ligand_filepath, cycle_atoms))
+    return groups
+
+
+def get_available_pdb_ids(ccp4_dir: Path) -> set[str]:
+    # PDB ids of the maps in ccp4_dir, read once per run and shared by all the ring types
     try:
-        l = []
+        return set(Path(file).stem.removesuffix('.ccp4') for _, _, files in os.walk(ccp4_dir) for file in files)
+    except Exception as e:
+        logging.error(e, stack_info=True, exc_info=True)
+    return set()
 
-        all_ccp4_files = ccp4_dir.glob('**/*')
-        pdb_ids_for_which_ccp4_is_available = [x.stem.removesuffix('.ccp4') for x in all_ccp4_files]
-        for f in Path(rootdir / 'validation_data' / ring_type / 'filtered_ligands').rglob("*"):
 
-            if f.is_file():
+def get_filepaths(rootdir: Path, pdb_ids_for_which_ccp4_is_available: set[str], ring_type: str):
+    try:
+        l = []
+
+        for root, _, files in os.walk(rootdir / 'validation_data' / ring_type / 'filtered_ligands'):
+            for file in files:
                 # get path
-                stem = f.stem
+                stem = Path(file).stem
                 pdb_id = stem.split('_')[1]
                 if pdb_id in pdb_ids_for_which_ccp4_is_available:
-                    l.append(f)
+                    l.append(Path(root) / file)
         logging.info(f"[{ring_type.capitalize()}]: There are {len(l)} PDB structures with corresponding CCP4 file "
                      f"available.")
     except Exception as e:
@@ -80,6 +127,27 @@ def get_filepaths(rootdir: Path, ccp4_dir: Path, ring_type: str):
     return l
 
 
+def get_archived_rings(rootdir: Path, pdb_ids_for_which_ccp4_is_available: set[str], ring_type: str):
+    # counterpart of get_filepaths for rings packed by FilterDataset, returns (filepath, atoms) of rings
+    # named as their files would be in filtered_ligands
+    try:
+        l = []
+
+        archive = RingArchive(rootdir / 'validation_data' / ring_type / RING_ARCHIVE)
+        for name, pdb_id in zip(archive.names, archive.pdb_ids):
+            if pdb_id in pdb_ids_for_which_ccp4_is_available:
+                # atoms are copied out of the memory-mapped columns, only the used rings are read
+                atoms = archive.get_atoms(str(name))
+                l.append((rootdir / 'validation_data' / ring_type / 'filtered_ligands' / str(name),
+                          {"serials": np.array(atoms["serials"]), "coordinates": np.array(atoms["coordinates"])}))
+        archive.close()
+        logging.info(f"[{ring_type.capitalize()}]: There are {len(l)} archived rings with corresponding CCP4 file "
+                     f"available.")
+    except Exception as e:
+        logging.error(e, stack_info=True, exc_info=True)
+    return l
+
+
 def run_analysis(args: argparse.Namespace):
     try:
         arguments = process_args(args)
@@ -90,13 +158,23 @@ def run_analysis(args: argparse.Namespace):
             params = params + "m"
 
         ring_types = ['cyclohexane', 'cyclopentane', 'benzene']
+        pdb_ids_for_which_ccp4_is_available = get_available_pdb_ids(Path(args.ccp4_dir))
+        logging.info(f"There are {len(pdb_ids_for_which_ccp4_is_available)} CCP4 files available.")
 
         for ring_type in ring_types:
             path_to_output = Path(args.rootdir).resolve() / "validation_data" / ring_type / "el-density-output"
 
             _create_output_folder(path_to_output)
-
-            filepaths = get_filepaths(Path(args.rootdir), Path(args.ccp4_dir), ring_type)
+            # patterns are numbered per ring type, so the boxes of every ring type are cached separately
+            if args.box_cache_dir is not None:
+                arguments.box_cache_dir = str(Path(args.box_cache_dir) / ring_type)
+
+            # rings are read from the ring archive when FilterDataset has written one
+            if is_ring_archive(Path(args.rootdir) / 'validation_data' / ring_type / RING_ARCHIVE):
+                filepaths = get_archived_rings(Path(args.rootdir), pdb_ids_for_which_ccp4_is_available, ring_type)
+            else:
+                filepaths = [(f, None) for f in get_filepaths(Path(args.rootdir), pdb_ids_for_which_ccp4_is_available,
+                                                              ring_type)]
             if len(filepaths) == 0:
                 logging.info(f"No files for analysis found for ring {ring_type}")
                 continue
@@ -106,9 +184,23 @@ def run_analysis(args: argparse.Namespace):
                 w = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
                 with Pool(int(CPU_COUNT)) as p:
-                    modified_filepaths = [(f, Path(args.ccp4_dir), arguments) for f in filepaths]
                     logging.info(f"[{ring_type.capitalize()}]: Starting analysis for {len(filepaths)} files...")
-                    rows = p.starmap(run_exe, modified_filepaths)
+                    if args.group_by_pdb or args.box_margin is not None or args.atom_intensities:
+                        # one task per PDB entry, rows are written in the order of filepaths
+                        groups = group_by_pdb_id(filepaths)
+                        logging.info(f"[{ring_type.capitalize()}]: Rings are grouped to {len(groups)} PDB entries.")
+                        entries = [(pdb_id, rings, Path(args.ccp4_dir), arguments) for pdb_id, rings in groups.items()]
+                        results = sorted((result for entry_results in p.starmap(run_exe_for_entry, entries, chunksize=1)
+                                          for result in entry_results), key=lambda result: result[0])
+                        rows = [row for _, row, _ in results]
+                        if args.atom_intensities:
+                            intensities_filename = ring_type + '_params_' + params + '_atom_intensities.csv'
+                            with open(path_to_output / intensities_filename, mode='w', newline='') as g:
+                                csv.writer(g, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL).writerows(
+                                    atom_row for _, _, atom_rows in results for atom_row in atom_rows)
+                    else:
+                        modified_filepaths = [(f, Path(args.ccp4_dir), arguments, atoms) for f, atoms in filepaths]
+                        rows = p.starmap(run_exe, modified_filepaths)
                     w.writerows(rows)
                     logging.info(f"[{ring_type.capitalize()}]: Finished analysis for {len(filepaths)} files.")
 
@@ -133,8 +225,24 @@ def main():
     parser.add_argument('-c', '--closest_voxel',
                         action='store_true', help='Instead of trilinear interpolation, the intensity of the closest '
                                                   'voxel is used')
-    
+    parser.add_argument('-g', '--group_by_pdb',
+                        action='store_true', help='Rings of the same PDB entry are analysed in one task, so that '
+                                                  'the map is read and its sigma is computed only once per entry')
+    parser.add_argument('-i', '--atom_intensities',
+                        action='store_true', help='The intensity and the coverage of every atom are written to '
+                                                  '<ring>_params_<params>_atom_intensities.csv (implies -g)')
+    parser.add_argument('-b', '--box_margin', type=float, default=None,
+                        help='Rings are analysed in boxes of the map around them with this margin in angstroms, '
+                             'the whole map is released after the boxes are cut out (implies -g)')
+    parser.add_argument('--box_cache_dir', type=str, default=None,
+                        help='Directory where the boxes and the sigma of every entry are cached, so that the maps '
+                             'are not read again by the following runs (requires -b)')
+
     args = parser.parse_args()
+    if args.box_margin is not None and args.box_margin < 0:
+        parser.error('box margin cannot be negative')
+    if args.box_cache_dir is not None and args.box_margin is None:
+        parser.error('--box_cache_dir requires --box_margin')
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s',
                         )
@@ -35,53 +35,44 @@ if [ $exit_code -ne 0 ]; then
 fi
 
 # Prepare dataset using PatternQuery
-python3 PrepareDataset.py -i "$INPUT_DATA_FOLDER/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"
+python3 PrepareDataset.py -x "$(nproc)" -i "$INPUT_DATA_FOLDER/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"
 exit_code=$?
 if [ $exit_code -ne 0 ]; then
     echo "Error: PrepareDataset failed with exit code $exit_code"
     exit $exit_code
 fi
 
-# Identify conformation of cyclohexane cycles
-python3 FilterDataset.py -r "cyclohexane" -i "$INPUT_DATA_FOLDER/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"
+# Filter out the wrong patterns of all the rings, the components dictionary is read only once
+# and the accepted patterns are hardlinked to the results of PatternQuery instead of copied
+python3 FilterDataset.py -r all -j "$(nproc)" -m hardlink -i "$INPUT_DATA_FOLDER/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"
 exit_code=$?
 if [ $exit_code -ne 0 ]; then
     echo "Error: FilterDataset failed with exit code $exit_code"
     exit $exit_code
 fi
+
+# Identify conformation of cyclohexane cycles
 FILTERED_LIGANDS_PATH="$OUTPUT_FOLDER/validation_data/cyclohexane/filtered_ligands"
 CC_OUTPUT_PATH="$OUTPUT_FOLDER/validation_data/cyclohexane/output"
 mkdir "$CC_OUTPUT_PATH"
-python3 SelectConformation.py "cyclohexane" "$FILTERED_LIGANDS_PATH" "$CC_OUTPUT_PATH"
+python3 SelectConformation.py -j "$(nproc)" "cyclohexane" "$FILTERED_LIGANDS_PATH" "$CC_OUTPUT_PATH"
 
 # Identify conformation of cyclopentane cycles
-python3 FilterDataset.py -r "cyclopentane" -i "$INPUT_DATA_FOLDER/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"
-exit_code=$?
-if [ $exit_code -ne 0 ]; then
-    echo "Error: FilterDataset failed with exit code $exit_code"
-    exit $exit_code
-fi
 FILTERED_LIGANDS_PATH="$OUTPUT_FOLDER/validation_data/cyclopentane/filtered_ligands"
 CC_OUTPUT_PATH="$OUTPUT_FOLDER/validation_data/cyclopentane/output"
 mkdir "$CC_OUTPUT_PATH"
-python3 SelectConformation.py "cyclopentane" "$FILTERED_LIGANDS_PATH" "$CC_OUTPUT_PATH"
+python3 SelectConformation.py -j "$(nproc)" "cyclopentane" "$FILTERED_LIGANDS_PATH" "$CC_OUTPUT_PATH"
 
 # Identify conformation of benzene cycles
 # Note: in directory QM_optimised_templates/benzene is file flat.pdb for benzene and another conformations for cyclohexane
-python3 FilterDataset.py -r "benzene" -i "$INPUT_DATA_FOLDER/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"
-exit_code=$?
-if [ $exit_code -ne 0 ]; then
-    echo "Error: FilterDataset failed with exit code $exit_code"
-    exit $exit_code
-fi
 FILTERED_LIGANDS_PATH="$OUTPUT_FOLDER/validation_data/benzene/filtered_ligands"
 CC_OUTPUT_PATH="$OUTPUT_FOLDER/validation_data/benzene/output"
 mkdir "$CC_OUTPUT_PATH"
-python3 SelectConformation.py "benzene" "$FILTERED_LIGANDS_PATH" "$CC_OUTPUT_PATH"
+python3 SelectConformation.py -j "$(nproc)" "benzene" "$FILTERED_LIGANDS_PATH" "$CC_OUTPUT_PATH"
 
 # analyse electron density coverage
 CCP4="${INPUT_DATA_FOLDER}/${DATA_FOLDER}/ccp4"
-python3 electron_density_coverage_analysis/main.py "$OUTPUT_FOLDER" "$CCP4"
+python3 electron_density_coverage_analysis/main.py -g "$OUTPUT_FOLDER" "$CCP4"
 
 # analyse and summarise results
 python3 RingAnalysisResult.py -r "$CYCLOPENTANE" -i "${INPUT_DATA_FOLDER}/${DATA_FOLDER}" -o "$OUTPUT_FOLDER"